@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the save state engine, runnable offline.
+
+A synthetic corpus of save files is generated from `data/OgreBattle_MotBQ.srm`
+(random statistics, valid checksums) and every operation is timed several
+times, keeping the best run. Results are printed as json and can be compared
+against a baseline: the exit code is 1 when some operation got slower than
+the baseline by more than the threshold.
+
+    ./benchmark.py [--files=N] [--repeat=N] [--baseline=FILE [--threshold=0.25]] [--save-baseline=FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import savestate
+from savestate import OgreBattleSaveState
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE = os.path.join(savestate.DATA_DIR, "OgreBattle_MotBQ.srm")
+DEFAULT_BASELINE = os.path.join(HERE, "benchmark_baseline.json")
+
+
+def generate_corpus(directory, count, seed=0):
+    """
+    Write `count` save files inside `directory`, copies of the template with
+    random unit statistics in the used slots. Return their paths.
+    """
+    rng = random.Random(seed)
+    with open(TEMPLATE, "rb") as f:
+        template = f.read()
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for i in range(count):
+        content = bytearray(template)
+        for index in range(3):
+            start = OgreBattleSaveState.START_ADDRESS + OgreBattleSaveState.SLOT_SIZE*index
+            if savestate.is_empty_slot(content[start:start+OgreBattleSaveState.SLOT_SIZE]):
+                continue
+            for offset, size, count_, info_name, deserialize, _1 in OgreBattleSaveState.UNIT_LAYOUT:
+                if deserialize is not savestate.bytes_to_num or size != 1:
+                    continue
+                for stride in range(count_):
+                    content[start + offset + stride] = rng.randint(1, 99)
+        file = os.path.join(directory, f"save_{i:05d}.srm")
+        with open(file, "wb") as f:
+            f.write(content)
+        savestate.check_file_checksums(file, repair=True)
+        files.append(file)
+    return files
+
+
+def measure(func, repeat):
+    # best wall time of `repeat` runs of `func`, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _used_slots(files):
+    return [(file, index) for file in files for index in range(3)
+            if not OgreBattleSaveState(file, index).is_empty()]
+
+
+def run(files, repeat, cli=True):
+    """
+    Time every operation over the corpus `files` and return
+    `{operation: {"seconds": ..., "ops": ..., "per_op": ...}}`.
+    """
+    slots = _used_slots(files)
+    states = [OgreBattleSaveState(file, index) for file, index in slots]
+    infos = [x[3] for x in OgreBattleSaveState.UNIT_LAYOUT if x[2] == OgreBattleSaveState.UNIT_COUNT]
+    results = {}
+
+    def record(name, ops, func, repeat=repeat):
+        seconds = measure(func, repeat)
+        results[name] = {"seconds": seconds, "ops": ops, "per_op": seconds/ops}
+
+    def construct():
+        for file, index in slots:
+            OgreBattleSaveState(file, index)
+    record("construct", len(slots), construct)
+
+    def decode_roster():
+        for obss in states:
+            obss._roster = None
+            roster = obss.get_roster()
+            for unit_index in range(len(roster)):
+                for info_name in infos:
+                    roster.get(unit_index, info_name).formatted
+    record("decode_roster", len(states), decode_roster)
+
+    def decode_get_info():
+        for obss in states:
+            for unit_index in range(OgreBattleSaveState.UNIT_COUNT):
+                for info_name in infos:
+                    obss.get_unit_info(unit_index, info_name).formatted
+    record("decode_get_info", len(states), decode_get_info)
+
+    def set_single():
+        for obss in states:
+            obss.set_unit_info(0, "STR", "50")
+    record("set_unit_info_single", len(states), set_single)
+
+    def set_bulk():
+        for obss in states:
+            for unit_index in range(OgreBattleSaveState.UNIT_COUNT):
+                for info_name in ("STR", "AGI", "INT"):
+                    obss.set_unit_info(unit_index, info_name, "99")
+    record("set_unit_info_bulk", len(states)*OgreBattleSaveState.UNIT_COUNT*3, set_bulk)
+
+    def checksum():
+        for obss in states:
+            obss.compute_checksum()
+    record("compute_checksum", len(states), checksum)
+
+    def save():
+        for obss in states:
+            obss.set_misc_info("MONEY", "12345")
+            obss.save()
+    record("save", len(states), save)
+
+    def save_no_fsync():
+        for obss in states:
+            obss.set_misc_info("MONEY", "12345")
+            obss.save(fsync=False)
+    record("save_no_fsync", len(states), save_no_fsync)
+
+    if cli:
+        file = files[0]
+        script = os.path.join(HERE, "consoleviewer.py")
+        def command(*args):
+            def func():
+                subprocess.run([sys.executable, script] + list(args), check=True,
+                               stdout=subprocess.DEVNULL)
+            return func
+        # process start to exit: a few runs are enough
+        cli_repeat = max(1, min(repeat, 3))
+        record("cli_show_unit", 1, command(file, "show", "unit", "0", "1", "2"), cli_repeat)
+        record("cli_update_unit", 1, command(file, "update", "unit", "0", "STR", "42"), cli_repeat)
+        record("cli_fsck", len(files), command("fsck", os.path.dirname(file)), cli_repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the operations slower than `baseline` by more than `threshold`
+    (e.g. 0.25 for 25%) as `{operation: ratio}`.
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["per_op"] / baseline[name]["per_op"]
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the save state engine")
+    parser.add_argument("-n", "--files", type=int, default=20, help="number of save files of the synthetic corpus")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs of every operation (the best one is kept)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-cli", action="store_true", help="do not time the CLI end to end")
+    parser.add_argument("-b", "--baseline", type=str, default=None, help=f"compare against this baseline (e.g. {os.path.basename(DEFAULT_BASELINE)})")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25, help="tolerated slowdown against the baseline")
+    parser.add_argument("-s", "--save-baseline", type=str, default=None, help="store the results as a new baseline")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="ogrebattle_bench_")
+    try:
+        files = generate_corpus(tmp_dir, args.files, args.seed)
+        results = run(files, args.repeat, cli=not args.no_cli)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "files": args.files,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        report["regressions"] = regressions
+    print(json.dumps(report, indent=4))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+            f.write("\n")
+    if args.baseline and report["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
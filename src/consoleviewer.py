@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 import argparse
+import json
+import os
+import sys
+import time
+import savestate
 from savestate import OgreBattleSaveState
 
 
@@ -13,8 +18,9 @@ class ConsoleViewer(object):
 
     def show_unit(self, unit_index, infos):
         print(f"=( {unit_index:>3d} )==" + "="*50)
+        roster = self.obss.get_roster()
         for info in infos:
-            data = self.obss.get_unit_info(unit_index, info)
+            data = roster.get(unit_index, info)
             print("{:>20s}: {:<20s} [@{:#06x} raw: {:<10s}]".format(
                 data.name,
                 data.formatted,
@@ -33,6 +39,36 @@ class ConsoleViewer(object):
                 as_bytes(data.raw),
             ))
 
+    def show_group(self, group, infos):
+        army = self.obss.get_army()
+        print(f"=[ group {group:>2d} ]==" + "="*47)
+        members = army.group(group)
+        if not members:
+            print("(empty)")
+        for unit_index in members:
+            leader = "*" if unit_index == army.leader(group) else " "
+            print(f"{leader}{unit_index:>3d} " + " ".join(
+                self.obss.get_unit_info(unit_index, info).formatted for info in infos))
+        print("-"*60)
+
+    def show_army(self):
+        army = self.obss.get_army()
+        roster = self.obss.get_roster()
+        for group, members in army:
+            names = ", ".join(roster.get(x, "NAME").formatted for x in members)
+            leader = roster.get(army.leader(group), "NAME").formatted
+            print(f"group {group:>2d}: {len(members)} units, leader {leader} ({names})")
+        print(f"{len(army)} groups, {len(army.barracks)} units in the barracks")
+
+    def query(self, expression, infos, index_only=False, all_units=False):
+        units = self.obss.find_units(expression, all_units)
+        if index_only:
+            print(" ".join(str(x) for x in units))
+            return
+        for unit_index in units:
+            self.show_unit(unit_index, infos)
+        print(f"{len(units)} units found")
+
     def update_unit(self, unit_index, info, new_value):
         old = self.obss.get_unit_info(unit_index, info)
         self.obss.set_unit_info(unit_index, info, new_value)
@@ -66,24 +102,299 @@ class ConsoleViewer(object):
         print("{:>20s}: {} [raw: {}]".format(current.name, current.value, as_bytes(current.raw)))
         print("{:>20s}: {} [raw: {}]".format(computed.name, computed.value, as_bytes(computed.raw)))
 
-    def save(self):
-        self.obss.save()
+    def save(self, mode=None, fsync=None):
+        self.obss.save(mode=mode, fsync=fsync)
+
+    def apply(self, edits, mode=None, fsync=None):
+        """
+        Apply many edits with a single save. Every edit is a dict like
+        `{"unit": 3, "info": "STR", "value": 255}` or, for misc infos,
+        `{"info": "MONEY", "value": 999999}`. If an edit fails, nothing is
+        saved at all. See `savestate.write_patches` for `mode` and `fsync`.
+        """
+        count = 0
+        with self.obss.transaction(mode=mode, fsync=fsync):
+            for edit in edits:
+                if "unit" in edit:
+                    self.update_unit(int(edit["unit"]), edit["info"], str(edit["value"]))
+                else:
+                    self.update_misc(edit["info"], str(edit["value"]))
+                count += 1
+        print(f"{count} edits applied")
+
+    def watch(self, interval=0.5):
+        """
+        Follow the modifications of the file (e.g. done by a running emulator)
+        and print every changed field of the slot as a json line.
+        """
+        # only watch needs it: keep ctypes & co. out of the other commands
+        import filewatch
+        watcher = filewatch.watcher(self.obss.file, interval)
+        base = {"file": self.obss.file, "slot": self.obss.index}
+        print(json.dumps(dict(base, event="watch", watcher=type(watcher).__name__)), flush=True)
+        try:
+            while True:
+                watcher.wait()
+                try:
+                    changes = self.obss.refresh()
+                except (OSError, RuntimeError) as e:
+                    # e.g. the file is being rewritten right now
+                    print(json.dumps(dict(base, event="error", error=str(e))), flush=True)
+                    continue
+                now = time.time()
+                for change in changes:
+                    print(json.dumps(dict(base, event="change", time=now, **change)))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
     def custom(self):
         print("Write your temporary code here!")
 
 
-def parse_args():
+def read_edits(file):
+    """
+    Yield the edits stored inside `file` ("-" for stdin), either as a json
+    list or as one json object per line (streamed).
+    """
+    f = sys.stdin if file == "-" else open(file, "r")
+    try:
+        first_line = f.readline()
+        while first_line and not first_line.strip():
+            first_line = f.readline()
+        if first_line.lstrip().startswith("["):
+            yield from json.loads(first_line + f.read())
+            return
+        if first_line.strip():
+            yield json.loads(first_line)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_on_files(func, paths, args, jobs=None):
+    """
+    Yield `func(file, *args)` for every save file inside `paths`, computed by
+    a pool of processes. `func` must return a json-friendly dict, which is
+    replaced by `{"file": ..., "error": ...}` when it raises.
+    """
+    files = list(savestate.find_save_files(paths))
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        # no pool at all: e.g. `--profile` measures this process only
+        yield from map(_run_on_file, [func]*len(files), files, [args]*len(files))
+        return
+    chunksize = max(1, len(files) // (jobs*4))
+    # imported here: it pulls in logging & co., useless to single-file commands
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(_run_on_file, [func]*len(files), files, [args]*len(files), chunksize=chunksize)
+
+def _run_on_file(func, file, args):
+    try:
+        return func(file, *args)
+    except Exception as e:
+        return {"file": file, "error": str(e)}
+
+def _fsck_file(file, repair):
+    return {"file": file, "slots": savestate.check_file_checksums(file, repair)}
+
+def fsck(paths, repair=False, jobs=None):
+    """
+    Check (and optionally repair) the checksums of every save file inside
+    `paths` with a pool of processes. Every file with some problem is printed
+    as a json line, followed by a json summary. Return the number of problems
+    that are still there.
+    """
+    summary = {"files": 0, "slots": 0, "ok": 0, "empty": 0, "mismatch": 0, "repaired": 0, "errors": 0}
+    for result in run_on_files(_fsck_file, paths, (repair, ), jobs):
+        summary["files"] += 1
+        if "error" in result:
+            summary["errors"] += 1
+            print(json.dumps(result))
+            continue
+        for slot in result["slots"]:
+            summary["slots"] += 1
+            summary[slot["status"]] += 1
+        if any(slot["status"] in ("mismatch", "repaired") for slot in result["slots"]):
+            print(json.dumps(result))
+    print(json.dumps({"summary": summary}))
+    return summary["mismatch"] + summary["errors"]
+
+def _patch_file(file, spec, dry_run, mode, fsync):
+    return {"file": file, "slots": savestate.patch_file(file, spec, dry_run=dry_run, mode=mode, fsync=fsync)}
+
+def patch(spec_file, paths, dry_run=False, jobs=None, mode=None, fsync=None):
+    """
+    Apply the patch inside `spec_file` (see `savestate.compile_patch`) to
+    every save file inside `paths` with a pool of processes. A json line is
+    printed for every file, followed by a json summary. Return the number of
+    files that could not be patched. See `savestate.write_patches` for `mode`
+    and `fsync`.
+    """
+    with open(spec_file, "r") as f:
+        spec = savestate.compile_patch(json.load(f))
+    summary = {"files": 0, "slots": 0, "units": 0, "errors": 0}
+    for result in run_on_files(_patch_file, paths, (spec, dry_run, mode, fsync), jobs):
+        summary["files"] += 1
+        print(json.dumps(result))
+        if "error" in result:
+            summary["errors"] += 1
+            continue
+        for slot in result["slots"]:
+            if slot["status"] == "patched":
+                summary["slots"] += 1
+                summary["units"] += len(slot["units"])
+    print(json.dumps({"summary": summary}))
+    return summary["errors"]
+
+def export(paths, records, format="ndjson", out=None):
+    """
+    Stream the records of `savestate.iter_records` to `out` (stdout by
+    default) either as json lines or as csv (csv needs a single kind of
+    records, since every kind has its own columns).
+    """
+    out = out or sys.stdout
+    if format == "ndjson":
+        for record in savestate.iter_records(paths, records):
+            out.write(json.dumps(record))
+            out.write("\n")
+    elif format == "csv":
+        if len(records) != 1:
+            raise RuntimeError("csv export needs exactly one kind of records!")
+        if records[0] == "unit":
+            columns = ["file", "slot", "unit"] + [x[3] for x in OgreBattleSaveState.UNIT_LAYOUT]
+        else:
+            columns = ["file", "slot"] + [x[3] for x in OgreBattleSaveState.MISC_LAYOUT]
+        import csv
+        writer = csv.DictWriter(out, columns, extrasaction="ignore")
+        writer.writeheader()
+        for record in savestate.iter_records(paths, records):
+            writer.writerow(record)
+    else:
+        raise RuntimeError(f"Unknown export format '{format}'!")
+
+def diff(file_a, file_b, slots=None, as_json=False):
+    """
+    Print the fields that differ between the slots of two save files (the
+    same slot of both files, or slot `slots[0]` of `file_a` against slot
+    `slots[1]` of `file_b`). Return the number of differences.
+    """
+    save_a = savestate.OgreBattleSaveFile(file_a)
+    save_b = save_a if file_b == file_a else savestate.OgreBattleSaveFile(file_b)
+    pairs = [slots] if slots else [(i, i) for i in range(3)]
+    count = 0
+    for slot_a, slot_b in pairs:
+        obss_a = save_a.slot(slot_a)
+        for change in savestate.diff_states(obss_a, save_b.slot(slot_b)):
+            count += 1
+            address = (OgreBattleSaveState.START_ADDRESS +
+                       slot_a*OgreBattleSaveState.SLOT_SIZE + change["offset"])
+            if as_json:
+                print(json.dumps(dict(change, slot_a=slot_a, slot_b=slot_b, address=address)))
+            elif change["layout"] is None:
+                print("SLOT {}/{} - unknown ({} bytes): {} -> {} [@{:#06x}]".format(
+                    slot_a, slot_b, change["size"], change["old"], change["new"], address))
+            else:
+                print("SLOT {}/{} - {} {} {}: {} -> {} [@{:#06x}]".format(
+                    slot_a, slot_b, change["layout"], change["index"], change["field"],
+                    change["old"], change["new"], address))
+    return count
+
+
+LIBRARY_COMMANDS = ("fsck", "patch", "export", "diff", )
+
+def _profile_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--profile", action="store_true", help="print to stderr the time spent loading, decoding, encoding, checksumming and saving")
+    parser.add_argument("--profile-dump", type=str, default=None, metavar="FILE", help="run under cProfile and write the pstats dump into FILE")
+    return parser
+
+def _save_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--save-mode", choices=("journal", "atomic", "inplace"), default=None, help=f"how files are written (default: {OgreBattleSaveState.SAVE_MODE})")
+    parser.add_argument("--no-fsync", action="store_true", help="do not wait for the data to reach the disk (faster, for batch jobs)")
+    return parser
+
+def _save_options(args):
+    # `mode` and `fsync` of `savestate.write_patches`
+    return {"mode": args.save_mode, "fsync": False if args.no_fsync else None}
+
+def print_stats(stats, out=None):
+    # breakdown of `savestate.stats`
+    out = out or sys.stderr
+    total = sum(x["seconds"] for x in stats.values())
+    print(f"{'OPERATION':<16} {'CALLS':>8} {'SECONDS':>10} {'%':>6}", file=out)
+    for key, value in stats.items():
+        share = 100*value["seconds"]/total if total else 0
+        print(f"{key:<16} {value['calls']:>8} {value['seconds']:>10.6f} {share:>6.1f}", file=out)
+
+def parse_library_args(argv):
+    """
+    Reference CLI for commands working on many files:
+
+    ./consoleviewer.py fsck [--repair] [--jobs=N] <DIR|FILE> [<DIR|FILE>...]
+    ./consoleviewer.py patch [--dry-run] [--jobs=N] [--save-mode={journal,atomic,inplace}] [--no-fsync] <SPEC.json> <DIR|FILE> [<DIR|FILE>...]
+    ./consoleviewer.py export [--format={ndjson,csv}] [--records={unit,misc}] <DIR|FILE> [<DIR|FILE>...]
+    ./consoleviewer.py diff [--slots SLOT_A SLOT_B] [--json] <FILE_A> <FILE_B>
+
+    Every command also accepts `--profile` and `--profile-dump=FILE` (the
+    worker processes are not used while profiling).
+    """
+    parser = argparse.ArgumentParser(prog="consoleviewer.py", description="interact with many SNES save state files at once")
+    profile_parser = _profile_parser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_fsck = subparsers.add_parser("fsck", parents=[profile_parser], description="verify the checksum of all slots of every .srm file (recursively)")
+    parser_fsck.add_argument("-r", "--repair", action="store_true", help="rewrite the wrong checksums")
+    parser_fsck.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser_fsck.add_argument("PATH", nargs="+")
+
+    parser_patch = subparsers.add_parser("patch", parents=[profile_parser, _save_parser()], description="apply the same patch to all slots of every .srm file (recursively)")
+    parser_patch.add_argument("-d", "--dry-run", action="store_true", help="show what would be patched but do not modify files")
+    parser_patch.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser_patch.add_argument("SPEC", type=str, help="json file describing the patch")
+    parser_patch.add_argument("PATH", nargs="+")
+
+    parser_export = subparsers.add_parser("export", parents=[profile_parser], description="stream units and misc data of every .srm file (recursively) to stdout")
+    parser_export.add_argument("-f", "--format", choices=("ndjson", "csv"), default="ndjson")
+    parser_export.add_argument("-r", "--records", choices=("unit", "misc"), default=[], action="append", help="leave empty to export both (only one kind is allowed by csv)")
+    parser_export.add_argument("PATH", nargs="+")
+
+    parser_diff = subparsers.add_parser("diff", parents=[profile_parser], description="show the fields that differ between two save files (or two slots)")
+    parser_diff.add_argument("-s", "--slots", type=int, nargs=2, metavar=("SLOT_A", "SLOT_B"), help="compare only SLOT_A of FILE_A with SLOT_B of FILE_B (default: all slots, pairwise)")
+    parser_diff.add_argument("--json", action="store_true", help="print the differences as json lines")
+    parser_diff.add_argument("FILE_A")
+    parser_diff.add_argument("FILE_B")
+
+    return parser.parse_args(argv)
+
+def parse_args(argv=None):
     """
     Reference CLI:
 
     ./consoleviewer.py <file> [--slot=N] show unit [--info={ALL,STR,...}, --info] <UNIT_INDEX> [<UNIT_INDEX>...]
     ./consoleviewer.py <file> [--slot=N] show misc {checksum, reputation, money}
+    ./consoleviewer.py <file> [--slot=N] show group [--info={NAME,CLASS,...}, --info] <GROUP> [<GROUP>...]
+    ./consoleviewer.py <file> [--slot=N] show army
+    ./consoleviewer.py <file> [--slot=N] query [--info={ALL,STR,...}, --info] [--index-only] [--all] <EXPRESSION>
     ./consoleviewer.py <file> [--slot=N] update unit <UNIT_INDEX> <INFO> <VALUE>
     ./consoleviewer.py <file> [--slot=N] update misc <INFO> <VALUE>
     ./consoleviewer.py <file> [--slot=N] fix-checksum [--dry-run]
+    ./consoleviewer.py <file> [--slot=N] apply [--save-mode={journal,atomic,inplace}] [--no-fsync] <EDITS.json|->
+    ./consoleviewer.py <file> [--slot=N] watch [--interval=SECONDS]
+    ./consoleviewer.py [--profile] [--profile-dump=FILE] <file> ...
+
+    See `parse_library_args` for the commands that work on many files.
     """
-    parser = argparse.ArgumentParser(description="interact with SNES save state files for 'Ogre Battle: the March of the Black Queen'")
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in LIBRARY_COMMANDS:
+        return parse_library_args(argv)
+    parser = argparse.ArgumentParser(parents=[_profile_parser()], description="interact with SNES save state files for 'Ogre Battle: the March of the Black Queen'")
     parser.add_argument("-s", "--slot", default=0, type=int)
     parser.add_argument("FILE")
 
@@ -99,6 +410,18 @@ def parse_args():
     parser_show_misc = subparsers_show.add_parser("misc")
     parser_show_misc.add_argument("-i", "--info", type=str, default=[], action="append", help="leave empty to display all misc infos")
 
+    parser_show_group = subparsers_show.add_parser("group", description="units of an army group (the leader is marked by '*')")
+    parser_show_group.add_argument("-i", "--info", type=str, default=[], action="append", help="leave empty to display NAME, CLASS and LVL")
+    parser_show_group.add_argument("GROUP", type=int, nargs="+")
+
+    parser_show_army = subparsers_show.add_parser("army", description="summary of all the non-empty army groups")
+
+    parser_query = subparsers.add_parser("query", description="show the units matching an expression like \"CLASS == 'Ninja' and LVL >= 10\"")
+    parser_query.add_argument("-i", "--info", type=str, default=[], action="append", help="leave empty to display all unit infos")
+    parser_query.add_argument("-l", "--index-only", action="store_true", help="print only the indexes of the matching units")
+    parser_query.add_argument("-a", "--all", action="store_true", help="include the unused places of the roster")
+    parser_query.add_argument("EXPRESSION", type=str)
+
     parser_update = subparsers.add_parser("update", description="modify data of save state")
     subparsers_update = parser_update.add_subparsers(dest="subcommand", required=True)
 
@@ -114,25 +437,71 @@ def parse_args():
     parser_fix_checksum = subparsers.add_parser("fix-checksum", description="show/solve problems related to the checksum")
     parser_fix_checksum.add_argument("-d", "--dry-run", action="store_true", help="show expected checksum but do not modify file")
 
+    parser_apply = subparsers.add_parser("apply", parents=[_save_parser()], description="apply many edits at once, saving only once (nothing is saved if an edit fails)")
+    parser_apply.add_argument("EDITS", type=str, help="json list (or one json object per line) of edits like {\"unit\": 3, \"info\": \"STR\", \"value\": 255} or {\"info\": \"MONEY\", \"value\": 999}; use '-' for stdin")
+
+    parser_watch = subparsers.add_parser("watch", description="follow the modifications of the file, printing the changed fields as json lines")
+    parser_watch.add_argument("-n", "--interval", type=float, default=0.5, help="polling interval, when inotify is not available")
+
     parser_custom = subparsers.add_parser("custom", description="entry-point to easily script some custom logic: no arguments and no code!")
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 def main():
     args = parse_args()
+    if args.profile:
+        savestate.enable_stats()
+        if hasattr(args, "jobs"):
+            args.jobs = 1
+    profiler = None
+    if args.profile_dump:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        rc = profiler.runcall(run, args) if profiler else run(args)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile_dump)
+        if args.profile:
+            print_stats(savestate.stats())
+    sys.exit(rc)
+
+def run(args):
+    # return the exit code of the command
+    if args.command == "fsck":
+        problems = fsck(args.PATH, repair=args.repair, jobs=args.jobs)
+        return 1 if problems else 0
+    elif args.command == "patch":
+        errors = patch(args.SPEC, args.PATH, dry_run=args.dry_run, jobs=args.jobs, **_save_options(args))
+        return 1 if errors else 0
+    elif args.command == "diff":
+        differences = diff(args.FILE_A, args.FILE_B, slots=args.slots, as_json=args.json)
+        return 1 if differences else 0
+    elif args.command == "export":
+        default_records = ["unit"] if args.format == "csv" else ["unit", "misc"]
+        export(args.PATH, args.records or default_records, format=args.format)
+        return 0
 
     viewer = ConsoleViewer(args.FILE, args.slot)
     command = args.command
 
+    ALL_UNIT_INFOS = ("NAME", "CLASS", "LVL", "EXP", "HP", "STR", "AGI", "INT", "CHA", "ALI", "LUK", "COST", "ITEM",)
     if command == "show":
         subcommand = args.subcommand
         if subcommand == "unit":
-            ALL_UNIT_INFOS = ("NAME", "CLASS", "LVL", "EXP", "HP", "STR", "AGI", "INT", "CHA", "ALI", "LUK", "COST", "ITEM",)
             for unit_index in args.UNIT_INDEX:
                 viewer.show_unit(unit_index, args.info or ALL_UNIT_INFOS)
         elif subcommand == "misc":
             ALL_MISC_INFOS = ("MONEY", "REPUTATION", "CHECKSUM")
             viewer.show_misc(args.info or ALL_MISC_INFOS)
+        elif subcommand == "group":
+            for group in args.GROUP:
+                viewer.show_group(group, args.info or ("NAME", "CLASS", "LVL"))
+        elif subcommand == "army":
+            viewer.show_army()
+
+    elif command == "query":
+        viewer.query(args.EXPRESSION, args.info or ALL_UNIT_INFOS, index_only=args.index_only, all_units=args.all)
 
     elif command == "update":
         subcommand = args.subcommand
@@ -147,9 +516,22 @@ def main():
         else:
             viewer.save()
 
+    elif command == "apply":
+        viewer.apply(read_edits(args.EDITS), **_save_options(args))
+
+    elif command == "watch":
+        viewer.watch(args.interval)
+
     elif command == "custom":
         viewer.custom()
 
+    return 0
+
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader of the output (e.g. `head`) went away: not an error
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
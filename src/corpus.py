@@ -0,0 +1,127 @@
+"""
+Optional NumPy backend: load a whole corpus of save files into arrays.
+
+Every file is read once into a single `(N, 3, SLOT_SIZE)` byte array and every
+field of `OgreBattleSaveState.UNIT_LAYOUT` (and `MISC_LAYOUT`) is then decoded
+with vectorized operations over all the files, slots and units at once, so
+statistics over tens of thousands of slots never call `get_info`.
+
+NumPy is not required by the rest of the tools: this module is the only one
+importing it.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import savestate
+from savestate import OgreBattleSaveState
+
+
+UNIT_COUNT = 100
+# unsigned little endian integer able to hold `size` bytes
+FORMATS = {1: "<u1", 2: "<u2", 3: "<u4", 4: "<u4"}
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("NumPy is required by the corpus backend: `pip install numpy`")
+
+def _layout_dtype(layout, count):
+    _require_numpy()
+    return np.dtype([(info_name, FORMATS[size])
+                     for _1, size, count_, info_name, _2, _3 in layout
+                     if count_ == count and size in FORMATS])
+
+def unit_dtype():
+    # only the fields stored for every unit (e.g. not "x9?")
+    return _layout_dtype(OgreBattleSaveState.UNIT_LAYOUT, UNIT_COUNT)
+
+def misc_dtype():
+    return _layout_dtype(OgreBattleSaveState.MISC_LAYOUT, 1)
+
+def _column(raw, offset, size, count, format):
+    # little endian decode of `count` consecutive `size`-bytes values of
+    # every slot: (N, 3, SLOT_SIZE) -> (N, 3, count)
+    end = offset + size*count
+    column = np.zeros(raw.shape[:-1] + (count, ), dtype=format)
+    for i in range(size):
+        column |= raw[..., offset+i:end:size].astype(format) << (8*i)
+    return column
+
+
+class Corpus(object):
+    """
+    Save files decoded as arrays:
+     * `files`: the N files, in load order
+     * `raw`: `(N, 3, SLOT_SIZE)` uint8, the content of every slot
+     * `empty`: `(N, 3)` bool, True for unused slots
+     * `used`: `(N, 3, 100)` bool, True for the units in use of the non-empty
+       slots (see `savestate.used_name_values`)
+     * `units`: `(N, 3, 100)` structured array with a field per unit info
+     * `misc`: `(N, 3)` structured array with a field per misc info
+    Values are the raw integers stored inside the save state (e.g. CLASS is
+    the class code: see `class_names`).
+    """
+
+    def __init__(self, files, raw):
+        self.files = files
+        self.raw = raw
+        self.empty = (raw == 0xFF).all(axis=-1)
+        self.units = self._decode(OgreBattleSaveState.UNIT_LAYOUT, unit_dtype(), UNIT_COUNT)
+        self.misc = self._decode(OgreBattleSaveState.MISC_LAYOUT, misc_dtype(), 1)[..., 0]
+        names = np.fromiter(savestate.used_name_values(), dtype=self.units.dtype["NAME"])
+        self.used = ~self.empty[..., None] & np.isin(self.units["NAME"], names)
+
+    def _decode(self, layout, dtype, count):
+        res = np.zeros(self.raw.shape[:-1] + (count, ), dtype=dtype)
+        for offset, size, _1, info_name, _2, _3 in layout:
+            if info_name in dtype.names:
+                res[info_name] = _column(self.raw, offset, size, count, dtype[info_name])
+        return res
+
+    def used_units(self):
+        # (M, ) units in use of the non-empty slots only
+        return self.units[self.used]
+
+    def mean_by_class(self, info_name):
+        """
+        Return `{class name: mean of info_name}` over the units in use of all
+        the non-empty slots.
+        """
+        units = self.used_units()
+        classes, inverse = np.unique(units["CLASS"], return_inverse=True)
+        sums = np.bincount(inverse, weights=units[info_name])
+        counts = np.bincount(inverse)
+        names = class_names()
+        return {names.get(int(value), "unknown"): float(total/count)
+                for value, total, count in zip(classes, sums, counts)}
+
+    def histogram(self, info_name, bins=10):
+        # numpy histogram of `info_name` over the units in use
+        return np.histogram(self.used_units()[info_name], bins=bins)
+
+
+def class_names():
+    # type: () -> dict
+    return {el["value"]: el["name"] for el in savestate.get_catalog("classes")}
+
+def load_corpus(paths):
+    """
+    Read all the save files inside `paths` (see `savestate.find_save_files`)
+    into a `Corpus`. Every file is read straight into its row of the array.
+    """
+    _require_numpy()
+    files = list(savestate.find_save_files(paths))
+    size = OgreBattleSaveState.SLOT_SIZE
+    start = OgreBattleSaveState.START_ADDRESS
+    raw = np.empty((len(files), 3*size), dtype=np.uint8)
+    for i, file in enumerate(files):
+        with open(file, "rb") as f:
+            f.seek(start)
+            read = f.readinto(memoryview(raw[i]))
+        if read != 3*size:
+            raise RuntimeError(
+                f"problem reading file {file}: " +
+                f"read {read} bytes instead of {3*size}")
+    return Corpus(files, raw.reshape(len(files), 3, size))
@@ -0,0 +1,123 @@
+"""
+Wait for the modification of a file: inotify (through ctypes) on linux,
+otherwise polling of mtime/size.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+class PollingWatcher(object):
+    """
+    Detect modifications by comparing `os.stat` (mtime, size, inode) every
+    `interval` seconds.
+    """
+
+    def __init__(self, file, interval=0.5):
+        self.file = file
+        self.interval = interval
+        self._stamp = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def wait(self, timeout=None):
+        # type: (float) -> bool
+        # return True when the file changed, False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stamp = self._stat()
+            if stamp != self._stamp:
+                self._stamp = stamp
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Detect modifications with linux inotify. The directory is watched, not
+    the file, so that files replaced by a rename are detected as well.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    EVENT = struct.Struct("iIII")
+    # emulators write in many chunks: wait for them to settle
+    SETTLE_TIME = 0.05
+
+    def __init__(self, file):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify not supported")
+        self.file = file
+        self.name = os.fsencode(os.path.basename(file))
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.path.dirname(os.path.abspath(file))
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"cannot watch {directory}")
+
+    def _read_events(self):
+        # True if some of the pending events are about the watched file
+        try:
+            buffer = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        found = False
+        i = 0
+        while i < len(buffer):
+            _1, _2, _3, size = self.EVENT.unpack_from(buffer, i)
+            i += self.EVENT.size
+            name = buffer[i:i+size].rstrip(b"\0")
+            i += size
+            found = found or name == self.name
+        return found
+
+    def wait(self, timeout=None):
+        # type: (float) -> bool
+        # return True when the file changed, False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _1, _2 = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._read_events():
+                # drain the burst of events of the same write
+                while select.select([self.fd], [], [], self.SETTLE_TIME)[0]:
+                    self._read_events()
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(file, interval=0.5):
+    """
+    Return the best watcher available for `file`: inotify or polling.
+    """
+    try:
+        return InotifyWatcher(file)
+    except (OSError, AttributeError):
+        return PollingWatcher(file, interval)
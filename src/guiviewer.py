@@ -4,18 +4,49 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkinter import simpledialog
 import argparse
+import collections
+import os
 
 import savestate
+import worker
 
 
 FONT = "verbena 12"
 FONT_BOLD = FONT + " bold"
+# ms between two polls of the results of the background worker
+POLL_INTERVAL = 50
+UNIT_INFOS = ["NAME", "CLASS", "LVL", "EXP", "HP", "STR", "AGI", "INT", "CHA", "ALI", "LUK", "COST", "ITEM",]
+
+
+def load_slot(job, file, slot):
+    # runs on the worker thread: it must not touch any Tk object, nor any
+    # object already used by the GUI, so the file is always read from scratch
+    job.report(f"Reading {os.path.basename(file)}...")
+    save_file = savestate.OgreBattleSaveFile(file)
+    if job.cancelled:
+        return None
+    job.report(f"Decoding slot {slot + 1}...")
+    obss = save_file.slot(slot)
+    obss.get_roster()
+    obss.get_army()
+    return save_file, obss
+
+def write_file(job, file, patches):
+    # runs on the worker thread: only I/O, the slots are not touched (see
+    # `savestate.collect_patches`)
+    job.report("Saving...")
+    savestate.write_patches(file, patches, savestate.OgreBattleSaveState.SAVE_MODE,
+                            savestate.OgreBattleSaveState.SAVE_FSYNC)
 
 
 class SelectorDialog(simpledialog.Dialog):
     """
     Simple dialog to let the user select an item from a list.
 
+    Typing inside the search box filters the list (see `savestate.Catalog.search`,
+    plain lists are scanned); <Return> picks the selected entry, or the only
+    one left by the search when nothing is selected.
+
     TODO:
      - show the "original value" (the value before selection)
      - show the "current value" (the selection, which can be hidden if the list
@@ -29,20 +60,42 @@ class SelectorDialog(simpledialog.Dialog):
 
     def body(self, body):
         body.columnconfigure(0, weight=1)
+        search_var = StringVar()
+        search_var.trace_add("write", lambda *args: self.on_search())
+        search = ttk.Entry(body, textvariable=search_var)
+        search.grid(column=0, columnspan=2, row=0, sticky=(E,W))
         listbox = Listbox(body, height=10)
-        listbox.grid(column=0, row=0, sticky=(N,E,S,W))
+        listbox.grid(column=0, row=1, sticky=(N,E,S,W))
         scrollbar = ttk.Scrollbar(body, orient=VERTICAL, command=listbox.yview)
-        scrollbar.grid(column=1, row=0, sticky=(N,S))
+        scrollbar.grid(column=1, row=1, sticky=(N,S))
         listbox["yscrollcommand"] = scrollbar.set
-        for i, el in enumerate(self.data):
-            listbox.insert("end", el["name"])
+        self.search_var = search_var
         self.listbox = listbox
-        return listbox
+        # entries currently inside the listbox
+        self.shown = []
+        self.on_search()
+        return search
+
+    def _search(self, text):
+        if hasattr(self.data, "search"):
+            return self.data.search(text)
+        text = text.lower()
+        return [el for el in self.data if text in str(el["name"]).lower()]
+
+    def on_search(self):
+        self.shown = self._search(self.search_var.get().strip())
+        self.listbox.delete(0, "end")
+        if self.shown:
+            self.listbox.insert("end", *(el["name"] for el in self.shown))
 
     def validate(self):
         if len(self.listbox.curselection()) == 0:
-            return 0
-        self.result = self.data[self.listbox.curselection()[0]]
+            # nothing picked: an untouched dialog must not write anything
+            if not self.search_var.get().strip() or len(self.shown) != 1:
+                return 0
+            self.result = self.shown[0]
+            return 1
+        self.result = self.shown[self.listbox.curselection()[0]]
         return 1
 
 
@@ -65,36 +118,59 @@ class EditorsFrame(ttk.Frame):
     Every <NAME> variable is then connected to the `on_value_changed` method
     that in turn will raise the `<<modified>>` virtual event.
 
+    Edits are debounced: the events are raised only after `DEBOUNCE_TIME` ms
+    without typing (or on <Return>, on focus out, on `flush`), once per editor
+    with its last value. Numbers that do not parse raise `<<invalid>>`
+    instead. Selectors transport the value of the chosen entry (an int), not
+    its name: names are not unique.
+
+    Images of the selectors are decoded only when first displayed and kept in
+    a small LRU cache (see `warm_sprites` to decode some of them ahead).
+
     No support for undo-redo.
     """
+    # decoded (and zoomed) images kept alive at once
+    SPRITE_CACHE_SIZE = 32
+    DEBOUNCE_TIME = 400
+
     def __init__(self, parent):
         super(EditorsFrame, self).__init__(parent)
         self._save_on_update = True
         self.editors = {}
-        self.__images_ref = {}
+        # <NAME> -> (value -> base64 gif, entry name -> value)
+        self.__sprites = {}
+        # (<NAME>, value) -> PhotoImage, least recently used first
+        self.__images_ref = collections.OrderedDict()
+        # <NAME> -> PhotoImage currently displayed (never evicted)
+        self.__images_shown = {}
+        # <NAME> -> entries listed by the selector (see `set_data`)
+        self.__data = {}
+        # <NAME> -> value edited but not notified yet
+        self.__pending = {}
+        self.__flush_id = None
+        self.__numeric = set()
 
         self._create_body()
 
         self.event_add("<<modified>>", "None")
+        self.event_add("<<invalid>>", "None")
         self.reset()
 
     def _create_body(self):
         raise NotImplementedError()
 
-    def _create_selector_editor(self, label_text="", name="", column=0, row=0, columnspan=1, rowspan=1, data=None):
+    def _create_selector_editor(self, label_text="", name="", column=0, row=0, columnspan=1, rowspan=1, data=None, images=None, style=None):
         if name.strip() == "":
             raise RuntimeError("Must specifiy a name for editor!")
         if name in self.editors:
             raise RuntimeError(f"Name '{name}' is already used!")
         if not data:
             raise RuntimeError(f"Cannot create selector for {name} with empty data!")
-        else:
-            for el in data:
-                if "img" not in el:
-                    continue
-                img_name = "{}_{}".format(name, el["name"])
-                img_data = el["img"]
-                self.__images_ref[img_name] = PhotoImage(data=img_data).zoom(3)
+        elif images:
+            # `images` maps the "value" of an entry to its base64 gif: they
+            # are decoded on first display
+            values = {el["name"]: el["value"] for el in data if el["value"] in images}
+            self.__sprites[name] = (images, values)
         if label_text:
             label = ttk.Label(self, text=label_text)
             label.grid(column=column, row=row, sticky=E)
@@ -103,11 +179,16 @@ class EditorsFrame(ttk.Frame):
         def callback(*args, **kwargs):
             self.on_value_changed(name, *args, **kwargs)
         variable.trace_add("write", callback)
+        self.__data[name] = data
         def command(name=name):
-            result = SelectorDialog(None, f"select {name}", data=data).result
+            result = SelectorDialog(None, f"select {name}", data=self.__data[name]).result
             if result:
                 self.editors[name].set(result["name"])
+                self.__pending[name] = result["value"]
+                self.flush()
         entry = ttk.Button(self, textvariable=variable, compound=TOP, command=command)
+        if style:
+            entry["style"] = style
         sticky = (W, )
         if columnspan > 1:
             sticky = (W, E)
@@ -119,6 +200,10 @@ class EditorsFrame(ttk.Frame):
         self.editors[f"{name}"] = variable
         self.editors[f"{name}_entry"] = entry
 
+    def set_data(self, name, data):
+        # entries listed by selector `name` from now on
+        self.__data[name] = data
+
     def _create_num_editor(self, label_text="", name="", column=0, row=0):
         if name.strip() == "":
             raise RuntimeError("Must specifiy a name for editor!")
@@ -133,24 +218,73 @@ class EditorsFrame(ttk.Frame):
         variable.trace_add("write", callback)
         entry = ttk.Entry(self, width=7, textvariable=variable)
         entry.grid(column=column+1, row=row, sticky=W, ipady=10)
+        entry.bind("<Return>", lambda event: self.flush())
+        entry.bind("<FocusOut>", lambda event: self.flush())
+        self.__numeric.add(name)
         self.editors[f"{name}_label"] = label
         self.editors[f"{name}"] = variable
         self.editors[f"{name}_entry"] = entry
 
+    def _sprite(self, name, value):
+        # decoded image of entry `value` of selector `name`, or None
+        key = (name, value)
+        if key in self.__images_ref:
+            self.__images_ref.move_to_end(key)
+            return self.__images_ref[key]
+        images, _1 = self.__sprites.get(name, ({}, None))
+        if value not in images:
+            return None
+        img = PhotoImage(data=images[value]).zoom(3)
+        self.__images_ref[key] = img
+        while len(self.__images_ref) > self.SPRITE_CACHE_SIZE:
+            self.__images_ref.popitem(last=False)
+        return img
+
+    def warm_sprites(self, name, values):
+        """
+        Decode ahead the images of `values` (e.g. the classes of the current
+        slot) of selector `name`, one per Tk idle slot so that the window stays
+        responsive. At most `SPRITE_CACHE_SIZE` are decoded.
+        """
+        pending = collections.deque(list(values)[:self.SPRITE_CACHE_SIZE])
+        def step():
+            if not pending:
+                return
+            value = pending.popleft()
+            if (name, value) not in self.__images_ref:
+                self._sprite(name, value)
+            self.after(1, step)
+        self.after_idle(step)
+
     def on_value_changed(self, name, *args, **kwargs):
         new_value = self.editors[name].get()
-        img_name = f"{name}_{new_value}"
-        if img_name in self.__images_ref:
-            img = self.__images_ref[img_name]
-            entry = self.editors[f"{name}_entry"]
-            entry.configure(image=img)
+        if name in self.__sprites:
+            img = self._sprite(name, self.__sprites[name][1].get(new_value))
+            if img is not None:
+                self.__images_shown[name] = img
+                entry = self.editors[f"{name}_entry"]
+                entry.configure(image=img)
         if not self._save_on_update:
             return
-        Event.VirtualEventData = (name, new_value)
-        self.event_generate("<<modified>>")
+        self.__pending[name] = new_value
+        if self.__flush_id is not None:
+            self.after_cancel(self.__flush_id)
+        self.__flush_id = self.after(self.DEBOUNCE_TIME, self.flush)
+
+    def flush(self):
+        # notify right now the pending edits, if any
+        if self.__flush_id is not None:
+            self.after_cancel(self.__flush_id)
+            self.__flush_id = None
+        pending, self.__pending = self.__pending, {}
+        for name, value in pending.items():
+            valid = name not in self.__numeric or value.strip().isdigit()
+            Event.VirtualEventData = (name, value)
+            self.event_generate("<<modified>>" if valid else "<<invalid>>")
 
     def update(self, data):
         # `data` should be a list of `savestate.ReadData`
+        self.flush()
         self._save_on_update = False
         for key, value in data.items():
             if key not in self.editors:
@@ -160,6 +294,7 @@ class EditorsFrame(ttk.Frame):
         self._save_on_update = True
 
     def reset(self):
+        self.flush()
         self._save_on_update = False
         for editor_name in self.editors:
             if isinstance(self.editors[editor_name], StringVar):
@@ -172,14 +307,8 @@ class CharacterInfoWidget(EditorsFrame):
     def _create_body(self):
         self.configure(padding="0 10 0 10")
 
-        name = StringVar()
-        name_entry = ttk.Label(self, textvariable=name)
-        name_entry.grid(column=0, columnspan=6, row=0, sticky=(N, E, W))
-        name_entry["style"] = "Title.TLabel"
-        self.editors["NAME"] = name
-        self.editors["NAME_entry"] = name_entry
-
-        self._create_selector_editor("", "CLASS", 1, 1, columnspan=2, rowspan=3, data=savestate.CLASSES)
+        self._create_selector_editor("", "NAME", 0, 0, columnspan=6, data=savestate.NAMES, style="Title.TButton")
+        self._create_selector_editor("", "CLASS", 1, 1, columnspan=2, rowspan=3, data=savestate.CLASSES, images=savestate.get_sprites("classes"))
         self._create_num_editor("Lvl:", "LVL", 3, 1)
         self._create_num_editor("Exp:", "EXP", 3, 2)
         self._create_num_editor("Cost:", "COST", 3, 3)
@@ -211,10 +340,71 @@ class MiscInfoWidget(EditorsFrame):
         self.columnconfigure(1, weight=1)
 
 
+class RosterTable(ttk.Frame):
+    """
+    All the units of a slot inside a `ttk.Treeview`, one row per unit.
+
+    Rows are filled from the bulk decode of `OgreBattleSaveState.get_roster`
+    and are never rebuilt: `show` sends to Tk only the rows whose values
+    changed. Double-clicking (or <Return> on) a row raises `<<selected>>`
+    with the index of the unit.
+    """
+    def __init__(self, parent, infos):
+        super(RosterTable, self).__init__(parent)
+        self.infos = infos
+        # unit index -> values currently displayed
+        self.__rows = {}
+        columns = ["#"] + list(infos)
+        tree = ttk.Treeview(self, columns=columns, show="headings", height=15, selectmode="browse")
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=50, anchor=E)
+        for column in ("NAME", "CLASS", "ITEM"):
+            tree.column(column, width=140, anchor=W)
+        tree.grid(column=0, row=0, sticky=(N, S, E, W))
+        scrollbar = ttk.Scrollbar(self, orient=VERTICAL, command=tree.yview)
+        scrollbar.grid(column=1, row=0, sticky=(N, S))
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.bind("<Double-1>", self.on_select)
+        tree.bind("<Return>", self.on_select)
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.event_add("<<selected>>", "None")
+        self.tree = tree
+
+    def show(self, obss, units=None):
+        # display `units` (by default all of them) of `obss`
+        roster = obss.get_roster()
+        units = range(len(roster)) if units is None else units
+        for unit_index in units:
+            values = (unit_index, ) + tuple(roster.get(unit_index, x).formatted for x in self.infos)
+            if self.__rows.get(unit_index) == values:
+                continue
+            iid = str(unit_index)
+            if unit_index in self.__rows:
+                self.tree.item(iid, values=values)
+            else:
+                self.tree.insert("", END, iid=iid, values=values)
+            self.__rows[unit_index] = values
+
+    def on_select(self, event):
+        selection = self.tree.selection()
+        if not selection:
+            return
+        Event.VirtualEventData = int(selection[0])
+        self.event_generate("<<selected>>")
+
+
 class OgreBattleSaveStateGUI():
 
     def __init__(self, file):
+        self.save_file = None
         self.obss = None
+        # file I/O and checksums run here, not on the Tk main loop
+        self.worker = worker.Worker()
+        self.__saving = False
+        # index of the unit inside the character view
+        self.__shown_character = 0
         # random container for images...otherwise images are garbage-collected
         # by python and never displayed in the GUI :(
         self.__images_ref = []
@@ -226,7 +416,8 @@ class OgreBattleSaveStateGUI():
         style.configure("ToolButton.TButton", relief=FLAT, borderwidth=2, padding=2)
         style.configure("Success.TLabel", foreground="#297f00", font=FONT_BOLD)
         style.configure("Error.TLabel", foreground="#7f0000", font=FONT_BOLD)
-        style.configure("Title.TLabel", foreground="#ffffff", background="#555555", font=FONT_BOLD, anchor=CENTER)
+        style.configure("Progress.TLabel", foreground="#555555", font=FONT_BOLD)
+        style.configure("Title.TButton", foreground="#ffffff", background="#555555", font=FONT_BOLD, anchor=CENTER)
 
         toolbar = self.__build_toolbar(root)
         toolbar.grid(column=0, row=0, sticky=(E, W))
@@ -237,11 +428,15 @@ class OgreBattleSaveStateGUI():
         main_view = ttk.Notebook(root)
         main_view.grid(column=0, row=2, sticky=(E, W))
         character_view = self.__build_character_view(main_view)
+        roster_view = self.__build_roster_view(main_view)
         formation_view = self.__build_formation_view(main_view)
         misc_view = self.__build_misc_view(main_view)
         main_view.add(character_view, text="Character")
+        main_view.add(roster_view, text="Roster")
         main_view.add(formation_view, text="Army formation")
         main_view.add(misc_view, text="Misc")
+        self.main_view = main_view
+        self.character_view = character_view
 
         status_bar = self.__build_status_bar(root)
         status_bar.grid(column=0, row=3, sticky=(N, E, W))
@@ -253,15 +448,23 @@ class OgreBattleSaveStateGUI():
             child.grid_configure(padx=5, pady=5)
 
         # display something sensible
+        self.root = root
         self.file_var.set(f"file: {file}")
         self.on_select_slot()
+        root.protocol("WM_DELETE_WINDOW", self.on_close)
+        root.after(POLL_INTERVAL, self.__poll_worker)
 
         root.mainloop()
 
+    def __poll_worker(self):
+        pending = self.worker.poll()
+        self.root.configure(cursor="watch" if pending else "")
+        self.root.after(POLL_INTERVAL, self.__poll_worker)
+
     def __build_toolbar(self, parent):
         actions = [
-            ("OPEN", "data/icon_open.gif", self.on_open),
-            ("SAVE", "data/icon_save.gif", self.on_save),
+            ("OPEN", os.path.join(savestate.DATA_DIR, "icon_open.gif"), self.on_open),
+            ("SAVE", os.path.join(savestate.DATA_DIR, "icon_save.gif"), self.on_save),
         ]
         COL_COUNT = len(actions)
 
@@ -310,6 +513,7 @@ class OgreBattleSaveStateGUI():
         character_info = CharacterInfoWidget(frame)
         character_info.grid(column=1, row=1, sticky=(E, W))
         character_info.bind("<<modified>>", self.on_character_modified)
+        character_info.bind("<<invalid>>", self.on_invalid_value)
         button_next = ttk.Button(frame, text=">", style="ToolButton.TButton", command=lambda:self.on_advance_character(+1))
         button_next.grid(column=2, row=1, sticky=(N, S))
 
@@ -317,11 +521,29 @@ class OgreBattleSaveStateGUI():
         self.character_info = character_info
         return frame
 
+    def __build_roster_view(self, parent):
+        roster_table = RosterTable(parent, UNIT_INFOS)
+        roster_table.bind("<<selected>>", self.on_roster_selected)
+        self.roster_table = roster_table
+        return roster_table
+
     def __build_formation_view(self, parent):
         frame = ttk.Frame(parent)
-        label = ttk.Label(frame, text="Not implemented yet :(")
-        label.grid(column=0, row=0)
-
+        frame.columnconfigure(0, weight=1)
+        frame.rowconfigure(0, weight=1)
+        columns = ("UNIT", "CLASS", "LVL")
+        tree = ttk.Treeview(frame, columns=columns, height=15)
+        tree.heading("#0", text="GROUP")
+        tree.column("#0", width=160)
+        for column in columns:
+            tree.heading(column, text=column)
+        tree.column("LVL", width=50, anchor=E)
+        tree.grid(column=0, row=0, sticky=(N, S, E, W))
+        scrollbar = ttk.Scrollbar(frame, orient=VERTICAL, command=tree.yview)
+        scrollbar.grid(column=1, row=0, sticky=(N, S))
+        tree.configure(yscrollcommand=scrollbar.set)
+
+        self.formation_tree = tree
         return frame
 
     def __build_misc_view(self, parent):
@@ -330,6 +552,7 @@ class OgreBattleSaveStateGUI():
         misc_info = MiscInfoWidget(frame)
         misc_info.grid(column=1, row=1, sticky=(E, W))
         misc_info.bind("<<modified>>", self.on_misc_modified)
+        misc_info.bind("<<invalid>>", self.on_invalid_value)
 
         self.misc_info = misc_info
         return frame
@@ -348,21 +571,48 @@ class OgreBattleSaveStateGUI():
         self.status_bar_entry = status_bar_entry
         return frame
 
-    def __update_backend(self):
+    def on_select_slot(self, *args, **kwargs):
         file = self.file_var.get()[6:]
         slot = self.slot_var.get()
-        self.obss = savestate.OgreBattleSaveState(file, slot)
-        self.character_info.reset()
+        if self.save_file is not None and self.save_file.file == file:
+            # the file is read once: switching slot does not touch the disk,
+            # and the slots (shared with the GUI) never go to the worker
+            try:
+                obss = self.save_file.slot(slot)
+            except Exception as e:
+                self.__on_slot_error(e)
+            else:
+                self.__on_slot_loaded((self.save_file, obss))
+            return
+        # a newer selection cancels the load of the previous one
+        self.worker.submit(load_slot, file, slot, key="load",
+                           callback=self.__on_slot_loaded,
+                           errback=self.__on_slot_error,
+                           progress=self.progress_message)
 
-    def on_select_slot(self, *args, **kwargs):
+    def __on_slot_loaded(self, result):
         try:
-            self.__update_backend()
+            # pending edits belong to the previous slot
+            self.character_info.reset()
+            self.misc_info.flush()
+            self.save_file, self.obss = result
+            # the opinion leader is named inside the slot itself
+            self.character_info.set_data("NAME", self.obss.names)
             self.character_var.set(0)
             self.on_select_character()
             self.__show_misc_info()
+            self.__show_formation()
+            self.roster_table.show(self.obss)
+            # most common classes of the slot first
+            classes = self.obss.get_roster().index("CLASS")
+            self.character_info.warm_sprites("CLASS", sorted(classes, key=lambda x: -len(classes[x])))
         except Exception as e:
             print("ERROR 'on_select_slot': {}".format(e))
 
+    def __on_slot_error(self, e):
+        self.warning_message("ERROR: problem loading the savestate")
+        print("ERROR 'on_select_slot': {}".format(e))
+
     def on_select_character(self):
         try:
             new_index = self.character_var.get()
@@ -383,19 +633,47 @@ class OgreBattleSaveStateGUI():
         else:
             self.__show_character_info(new_index)
 
+    def on_roster_selected(self, event, *args, **kwargs):
+        unit_index = event.VirtualEventData
+        self.character_var.set(unit_index)
+        self.__show_character_info(unit_index)
+        self.main_view.select(self.character_view)
+
     def __show_character_info(self, character_index):
-        INFOS = ["NAME", "CLASS", "LVL", "EXP", "HP", "STR", "AGI", "INT", "CHA", "ALI", "LUK", "COST", "ITEM",]
         try:
-            character_info = {}
-            for key in INFOS:
-                character_info[key] = self.obss.get_unit_info(character_index, key)
+            # the pending edits are written to the unit shown until now
+            self.character_info.flush()
+            character_info = self.obss.get_roster().row(character_index, UNIT_INFOS)
             self.character_info.update(character_info)
+            self.__shown_character = character_index
             character_name = character_info["NAME"].formatted
             self.success_message(f"Showing info for '{character_name}' (index {character_index})")
         except Exception as e:
             self.warning_message(f"Problems retrieving info for character at index {character_index}")
             print("ERROR '__show_character_info': {}".format(e))
 
+    def __show_formation(self):
+        try:
+            tree = self.formation_tree
+            tree.delete(*tree.get_children())
+            army = self.obss.get_army()
+            roster = self.obss.get_roster()
+            def insert_unit(parent, text, unit_index):
+                values = [roster.get(unit_index, x).formatted for x in ("NAME", "CLASS", "LVL")]
+                tree.insert(parent, END, text=text, values=values)
+            for group, members in army:
+                parent = tree.insert("", END, text=f"group {group}", open=True)
+                for unit_index in members:
+                    leader = " (leader)" if unit_index == army.leader(group) else ""
+                    insert_unit(parent, f"{unit_index}{leader}", unit_index)
+            if army.barracks:
+                parent = tree.insert("", END, text="barracks")
+                for unit_index in army.barracks:
+                    insert_unit(parent, f"{unit_index}", unit_index)
+        except Exception as e:
+            self.warning_message("Problems retrieving army formation")
+            print("ERROR '__show_formation': {}".format(e))
+
     def __show_misc_info(self):
         INFOS = ["REPUTATION", "MONEY"]
         try:
@@ -407,11 +685,26 @@ class OgreBattleSaveStateGUI():
             self.warning_message("Problems retrieving misc info")
             print("ERROR '__show_misc_info': {}".format(e))
 
+    def __reject_while_saving(self):
+        if self.__saving:
+            self.warning_message("Wait for the save to complete")
+        return self.__saving
+
     def on_character_modified(self, event, *args, **kwargs):
         try:
             (name, value) = event.VirtualEventData
-            unit_index = self.character_var.get()
-            self.obss.set_unit_info(unit_index, name, value)
+            unit_index = self.__shown_character
+            if self.__reject_while_saving():
+                self.__show_character_info(unit_index)
+                return
+            if isinstance(value, int):
+                # chosen by a selector: the name alone could be ambiguous
+                self.obss.set_unit_value(unit_index, name, value)
+            else:
+                self.obss.set_unit_info(unit_index, name, value)
+            self.roster_table.show(self.obss, [unit_index])
+            if self.obss.get_army().group_of_unit(unit_index) is not None:
+                self.__show_formation()
             message = f"{name} successfully updated"
             self.success_message(message)
         except Exception as e:
@@ -419,9 +712,16 @@ class OgreBattleSaveStateGUI():
             self.warning_message(message)
             print("ERROR 'on_character_modified': {}".format(e))
 
+    def on_invalid_value(self, event, *args, **kwargs):
+        (name, value) = event.VirtualEventData
+        self.warning_message(f"Invalid value for {name}: '{value}'")
+
     def on_misc_modified(self, event, *args, **kwargs):
         try:
             (name, value) = event.VirtualEventData
+            if self.__reject_while_saving():
+                self.__show_misc_info()
+                return
             self.obss.set_misc_info(name, value)
             message = f"{name} successfully updated"
             self.success_message(message)
@@ -431,27 +731,57 @@ class OgreBattleSaveStateGUI():
             print("ERROR 'on_misc_modified': {}".format(e))
 
     def on_save(self):
-        try:
-            self.obss.save()
-            self.success_message("Save completed!")
-        except Exception as e:
-            self.warning_message("ERROR: problem persisting changes")
-            print("ERROR 'on_save': {}".format(e))
+        if self.obss is None or self.__saving:
+            return
+        self.character_info.flush()
+        self.misc_info.flush()
+        # every slot edited since the last save, not only the one shown; the
+        # checksums are updated here, the worker only writes the bytes
+        states = self.save_file.modified_slots()
+        if self.obss not in states:
+            # as always, the checksum of the slot shown is rewritten anyway
+            states.append(self.obss)
+        patches = savestate.collect_patches(states)
+        # edits are rejected until the save completes
+        self.__saving = True
+        self.worker.submit(write_file, self.save_file.file, patches,
+                           callback=lambda result: self.__on_saved(states),
+                           errback=self.__on_save_error,
+                           progress=self.progress_message)
+
+    def __on_saved(self, states):
+        self.__saving = False
+        savestate.mark_saved(states)
+        self.success_message("Save completed!")
+
+    def __on_save_error(self, e):
+        self.__saving = False
+        self.warning_message("ERROR: problem persisting changes")
+        print("ERROR 'on_save': {}".format(e))
 
     def on_open(self):
         new_file = filedialog.askopenfilename()
         if new_file:
+            self.save_file = None
             self.file_var.set(f"file: {new_file}")
             self.slot_var.set(0)
             self.on_select_slot()
-            self.success_message("Changed file!")
         else:
             self.warning_message("New file not opened")
 
+    def on_close(self):
+        # a save still running is completed before leaving
+        self.worker.close()
+        self.root.destroy()
+
     def warning_message(self, message):
         self.status_bar_entry.config(style="Error.TLabel")
         self.status_bar.set(message)
 
+    def progress_message(self, message):
+        self.status_bar_entry.config(style="Progress.TLabel")
+        self.status_bar.set(message)
+
     def success_message(self, message):
         self.status_bar_entry.config(style="Success.TLabel")
         self.status_bar.set(message)
@@ -459,7 +789,7 @@ class OgreBattleSaveStateGUI():
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--file", default="data/OgreBattle_MotBQ.srm")
+    parser.add_argument("--file", default=os.path.join(savestate.DATA_DIR, "OgreBattle_MotBQ.srm"))
     args = parser.parse_args()
     OgreBattleSaveStateGUI(args.file)
 
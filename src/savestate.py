@@ -1,20 +1,316 @@
+import array
+import bisect
 import collections
+import contextlib
+import fnmatch
+import functools
 import json
+import operator
+import os
+import pickle
+import struct
+import sys
+import time
+import warnings
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks (e.g. windows): concurrent saves are not serialized
+    fcntl = None
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+CACHE_VERSION = 1
 
 def extractJson(file_name):
     with open(file_name, "r") as f:
         return json.load(f)
 
-ITEMS = extractJson("data/items.json")
-CLASSES = extractJson("data/classes.json")
-NAMES = extractJson("data/names.json")
+def _caller_stacklevel():
+    # `stacklevel` of `warnings.warn` pointing at the first caller outside of
+    # this module, however deep the call happens
+    frame = sys._getframe(1)
+    level = 1
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+        level += 1
+    return level
+
+class Catalog(object):
+    """
+    Ordered list of `{"value": ..., "name": ...}` entries (names, classes,
+    items) with hashed indexes on both keys.
+
+    The indexes are kept in sync by `append`. When several entries share the
+    same key the first one wins (as a linear scan would do), but names that
+    are not unique are tracked inside `self.duplicates` and encoding them
+    raises a warning since the chosen value could be the wrong one.
+
+    `search` finds the names containing a text through an index of the
+    (lowercase) substrings of up to `NGRAM` characters, built on first use.
+    """
+
+    NGRAM = 3
+
+    def __init__(self, entries=()):
+        self.entries = []
+        self.by_value = {}
+        self.by_name = {}
+        self.duplicates = {}
+        # substring -> positions inside `entries` (see `search`)
+        self._ngrams = None
+        for entry in entries:
+            self.append(entry)
+
+    def append(self, entry):
+        self._ngrams = None
+        self.entries.append(entry)
+        self.by_value.setdefault(entry["value"], entry)
+        first = self.by_name.setdefault(entry["name"], entry)
+        if first is not entry:
+            self.duplicates.setdefault(entry["name"], [first]).append(entry)
+
+    def find(self, key, value, default=None):
+        if key == "value":
+            return self.by_value.get(value, default)
+        if key == "name":
+            return self.by_name.get(value, default)
+        return findInsideList(self.entries, key, value, default)
+
+    def find_name(self, name, default=None):
+        # type: (str, dict) -> dict
+        if name in self.duplicates:
+            values = ", ".join(str(el["value"]) for el in self.duplicates[name])
+            warnings.warn(
+                f"name '{name}' is shared by values {values}: using the first one",
+                stacklevel=_caller_stacklevel())
+        return self.by_name.get(name, default)
+
+    def values_of(self, name):
+        # type: (str) -> list
+        # all the values sharing `name` (no warning, no ambiguity)
+        if name in self.duplicates:
+            return [el["value"] for el in self.duplicates[name]]
+        if name in self.by_name:
+            return [self.by_name[name]["value"]]
+        return []
+
+    def _build_ngrams(self):
+        ngrams = collections.defaultdict(list)
+        for position, entry in enumerate(self.entries):
+            name = str(entry["name"]).lower()
+            seen = set()
+            for size in range(1, Catalog.NGRAM + 1):
+                for i in range(len(name) - size + 1):
+                    seen.add(name[i:i+size])
+            for ngram in seen:
+                ngrams[ngram].append(position)
+        self._ngrams = dict(ngrams)
+
+    def search(self, text):
+        # type: (str) -> list
+        """
+        Return the entries whose name contains `text` (ignoring case): the
+        names starting with `text` first, then the others, in catalog order.
+        """
+        text = text.lower()
+        if not text:
+            return list(self.entries)
+        if self._ngrams is None:
+            self._build_ngrams()
+        if len(text) <= Catalog.NGRAM:
+            positions = self._ngrams.get(text, [])
+        else:
+            # candidates share all the ngrams of `text`: check the rarest one
+            ngrams = [text[i:i+Catalog.NGRAM] for i in range(len(text) - Catalog.NGRAM + 1)]
+            positions = min((self._ngrams.get(x, []) for x in ngrams), key=len)
+        prefix, others = [], []
+        for position in positions:
+            entry = self.entries[position]
+            name = str(entry["name"]).lower()
+            if name.startswith(text):
+                prefix.append(entry)
+            elif text in name:
+                others.append(entry)
+        return prefix + others
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+
+class CatalogOverlay(object):
+    """
+    View of a shared `Catalog` extended with some private entries.
+
+    Lookups hit the shared catalog first and fall back to the private entries
+    (exactly as if they were appended at the end of the shared catalog), but
+    the shared catalog is never modified: many overlays can coexist without
+    making the shared catalog grow.
+    """
+
+    def __init__(self, base, entries=()):
+        self.base = base
+        self.overlay = Catalog(entries)
+
+    def append(self, entry):
+        self.overlay.append(entry)
+
+    def find(self, key, value, default=None):
+        res = self.base.find(key, value)
+        if res is None:
+            res = self.overlay.find(key, value, default)
+        return res
+
+    def find_name(self, name, default=None):
+        # type: (str, dict) -> dict
+        if name in self.base.by_name:
+            return self.base.find_name(name, default)
+        return self.overlay.find_name(name, default)
+
+    def values_of(self, name):
+        # type: (str) -> list
+        return self.base.values_of(name) + self.overlay.values_of(name)
+
+    def search(self, text):
+        # type: (str) -> list
+        # prefix matches of both catalogs first (see `Catalog.search`)
+        found = self.base.search(text) + self.overlay.search(text)
+        text = text.lower()
+        return ([x for x in found if str(x["name"]).lower().startswith(text)] +
+                [x for x in found if not str(x["name"]).lower().startswith(text)])
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.overlay
+
+    def __len__(self):
+        return len(self.base) + len(self.overlay)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < len(self.base):
+            return self.base[index]
+        return self.overlay[index - len(self.base)]
+
 
 def findInsideList(list_, key, value, default=None):
+    if isinstance(list_, (Catalog, CatalogOverlay)):
+        return list_.find(key, value, default)
     for el in list_:
         if el[key] == value:
             return el
     return default
 
+def _file_digest(file_name):
+    # only needed when the stamp of a table changed
+    import hashlib
+    with open(file_name, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _split_tables(entries):
+    # the base64 sprites are only needed by the GUI: keep them apart so that
+    # the CLI never has to deserialize them
+    stripped = []
+    sprites = {}
+    for el in entries:
+        el = dict(el)
+        img = el.pop("img", None)
+        if img is not None:
+            sprites[el["value"]] = img
+        stripped.append(el)
+    return {"entries": stripped, "sprites": sprites}
+
+def _read_cache(cache_file, stamp, json_file):
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != CACHE_VERSION:
+        return None
+    if cached["stamp"] == stamp:
+        return cached["table"]
+    # mtime can change without the content changing (e.g. git checkout)
+    if cached["digest"] == _file_digest(json_file):
+        # store the new stamp, so that the next start does not hash again
+        _write_cache(cache_file, stamp, cached["digest"], cached["table"])
+        return cached["table"]
+    return None
+
+def _write_cache(cache_file, stamp, digest, table):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump({
+                "version": CACHE_VERSION,
+                "stamp": stamp,
+                "digest": digest,
+                "table": table,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # a read-only installation simply runs without cache
+        pass
+
+def load_table(name, part="entries", data_dir=None, cache_dir=None):
+    """
+    Return one part ("entries" or "sprites") of `<data_dir>/<name>.json`.
+
+    Parsed tables are stored as pickles inside `cache_dir` (by default
+    `<data_dir>/__pycache__`, or `$OGREBATTLE_CACHE_DIR`) and reused as long
+    as the json file has the same mtime/size or, failing that, the same
+    content hash.
+    """
+    data_dir = data_dir or DATA_DIR
+    cache_dir = (cache_dir or os.environ.get("OGREBATTLE_CACHE_DIR") or
+                 os.path.join(data_dir, "__pycache__"))
+    json_file = os.path.join(data_dir, f"{name}.json")
+    st = os.stat(json_file)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cache_file = os.path.join(cache_dir, f"{name}.{part}.pickle")
+    table = _read_cache(cache_file, stamp, json_file)
+    if table is not None:
+        return table
+    tables = _split_tables(extractJson(json_file))
+    digest = _file_digest(json_file)
+    for key, value in tables.items():
+        _write_cache(os.path.join(cache_dir, f"{name}.{key}.pickle"),
+                     stamp, digest, value)
+    return tables[part]
+
+_CATALOGS = {}
+
+def get_catalog(name):
+    # type: (str) -> Catalog
+    if name not in _CATALOGS:
+        _CATALOGS[name] = Catalog(load_table(name))
+    return _CATALOGS[name]
+
+def get_sprites(name="classes"):
+    # type: (str) -> dict
+    return load_table(name, "sprites")
+
+_CATALOG_ALIASES = {
+    "ITEMS": "items",
+    "CLASSES": "classes",
+    "NAMES": "names",
+}
+
+def __getattr__(attr):
+    # `savestate.ITEMS` & co. are loaded on first access
+    if attr in _CATALOG_ALIASES:
+        return get_catalog(_CATALOG_ALIASES[attr])
+    raise AttributeError(f"module '{__name__}' has no attribute '{attr}'")
+
 def bytes_to_int(data):
     # type: (bytes) -> int
     assert(isinstance(data, (bytes, bytearray, )))
@@ -64,23 +360,27 @@ def str_to_bytes(data):
 def bytes_to_class(data):
     # type: (bytes) -> str
     assert(isinstance(data, (bytes, bytearray, )))
-    res = findInsideList(CLASSES, "value", bytes_to_int(data), {"name": "unknown"})
+    res = get_catalog("classes").find("value", bytes_to_int(data), {"name": "unknown"})
     return res["name"]
 
 def class_to_bytes(data):
     # type: (str) -> bytes
-    res = findInsideList(CLASSES, "name", data, {"value": 0})
+    res = get_catalog("classes").find_name(data, {"value": 0})
     return int_to_bytes(res["value"])
 
-def bytes_to_name(data):
-    # type: (bytes) -> str
+def bytes_to_name(data, names=None):
+    # type: (bytes, Catalog) -> str
     assert(isinstance(data, (bytes, bytearray, )))
-    res = findInsideList(NAMES, "value", bytes_to_int(data), {"name": "unknown"})
+    if names is None:
+        names = get_catalog("names")
+    res = names.find("value", bytes_to_int(data), {"name": "unknown"})
     return res["name"]
 
-def name_to_bytes(data):
-    # type: (str) -> bytes
-    res = findInsideList(NAMES, "name", data, {"value": 0})
+def name_to_bytes(data, names=None):
+    # type: (str, Catalog) -> bytes
+    if names is None:
+        names = get_catalog("names")
+    res = names.find_name(data, {"value": 0})
     return int_to_bytes(res["value"])
 
 def bytes_to_item(data):
@@ -88,18 +388,580 @@ def bytes_to_item(data):
     assert(isinstance(data, (bytes, bytearray, )))
     if bytes_to_int(data) == 0:
         return "none"
-    res = findInsideList(ITEMS, "value", bytes_to_int(data), {"name": "unknown", "descr": ""})
+    res = get_catalog("items").find("value", bytes_to_int(data), {"name": "unknown", "descr": ""})
     return res["name"]
 
 def item_to_bytes(data):
     # type: (str) -> bytes
     if data == "none":
         return [0x00]
-    res = findInsideList(ITEMS, "name", data, {"value": 0})
+    res = get_catalog("items").find_name(data, {"value": 0})
     return int_to_bytes(res["value"])
 
-ReadData = collections.namedtuple("ReadData",
-    ("name", "value", "formatted", "raw", "address"))
+_UNSET = object()
+
+
+class ReadData(object):
+    """
+    Result of a read: `name`, `value` (the raw integer), `formatted` (the
+    deserialized value), `raw` (the bytes) and `address` (inside the file).
+
+    Reads made by `Field.read` are lazy: `raw` and `formatted` are computed
+    from `value` only when accessed, so callers interested in a single part
+    do not pay for the others (e.g. the catalog lookup of a NAME).
+    """
+
+    __slots__ = ("name", "value", "address", "_formatted", "_raw", "_size", "_deserialize")
+    _fields = ("name", "value", "formatted", "raw", "address")
+
+    def __init__(self, name, value, formatted, raw, address):
+        self.name = name
+        self.value = value
+        self.address = address
+        self._formatted = formatted
+        self._raw = raw
+
+    @classmethod
+    def lazy(cls, name, value, address, size, deserialize):
+        res = cls(name, value, _UNSET, _UNSET, address)
+        res._size = size
+        res._deserialize = deserialize
+        return res
+
+    @property
+    def raw(self):
+        if self._raw is _UNSET:
+            self._raw = bytearray(self.value.to_bytes(self._size, "little"))
+        return self._raw
+
+    @property
+    def formatted(self):
+        if self._formatted is _UNSET:
+            self._formatted = self._deserialize(bytearray(self.raw))
+        return self._formatted
+
+    def __iter__(self):
+        # unpack like the namedtuple it used to be
+        return iter(tuple(getattr(self, x) for x in self._fields))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, ReadData):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __hash__(self):
+        # `raw` is mutable (bytearray): hash an immutable copy, consistent
+        # with `__eq__` since bytes == bytearray
+        return hash((self.name, self.value, self.formatted, bytes(self.raw), self.address))
+
+    def __repr__(self):
+        return "ReadData({})".format(", ".join(f"{x}={getattr(self, x)!r}" for x in self._fields))
+
+
+def used_name_values():
+    # type: () -> set
+    """
+    NAME values of the units in use. The unused places of the roster are
+    filled with garbage (e.g. 0x55 bytes) whose NAME is not a known name,
+    while the opinion leader is named through `OPINION_LEADER_NAME_REF`.
+    """
+    return set(get_catalog("names").by_value) | {OgreBattleSaveState.OPINION_LEADER_NAME_REF}
+
+
+class UnitTable(object):
+    """
+    Column-oriented snapshot of all the `UNIT_LAYOUT` fields of a slot.
+
+    Every field is decoded with a single bulk copy into a typed `array` (one
+    raw integer per unit), so reading the whole roster costs one operation per
+    field instead of one `get_info` per field per unit.
+    """
+
+    TYPECODES = {1: "B", 2: "H"}
+
+    def __init__(self, obss):
+        self.obss = obss
+        self.columns = {}
+        self._indexes = {}
+        self._used = None
+        with memoryview(obss.data) as view:
+            for field in OgreBattleSaveState.FIELDS["UNIT"].values():
+                size, count = field.size, field.count
+                chunk = view[field.offset:field.offset+size*count]
+                if size in UnitTable.TYPECODES:
+                    column = array.array(UnitTable.TYPECODES[size])
+                    assert(column.itemsize == size)
+                    column.frombytes(chunk)
+                    # the snes stores everything as little endian
+                    if size > 1 and sys.byteorder != "little":
+                        column.byteswap()
+                else:
+                    column = array.array("L", (
+                        bytes_to_int(bytes(chunk[i:i+size]))
+                        for i in range(0, size*count, size)))
+                chunk.release()
+                self.columns[field.name] = column
+
+    def __getitem__(self, info_name):
+        return self.columns[info_name]
+
+    def __len__(self):
+        return len(self.columns["CLASS"])
+
+    def _field(self, info_name, unit_index):
+        # type: (str, int) -> tuple
+        # `Field` and its relative address: the checks are the ones of `Field`
+        field = OgreBattleSaveState.FIELDS["UNIT"].get(info_name)
+        if field is None:
+            field = self.obss._find_field("UNIT", info_name)
+        return field, field._address(unit_index)
+
+    def value(self, unit_index, info_name):
+        self._field(info_name, unit_index)
+        return self.columns[info_name][unit_index]
+
+    def get(self, unit_index, info_name):
+        # same result of `OgreBattleSaveState.get_unit_info`
+        field, address = self._field(info_name, unit_index)
+        return ReadData.lazy(
+            name=info_name,
+            value=self.columns[info_name][unit_index],
+            address=self.obss.base_address + address,
+            size=field.size,
+            deserialize=self.obss.bind_codec(field.deserialize),
+        )
+
+    def row(self, unit_index, infos):
+        return {info: self.get(unit_index, info) for info in infos}
+
+    def update(self, changes):
+        # apply the UNIT changes of `group_changes` to the columns
+        for change in changes:
+            if change["layout"] != "UNIT":
+                continue
+            info_name, unit_index = change["field"], change["index"]
+            address, size = change["offset"], change["size"]
+            self.columns[info_name][unit_index] = int.from_bytes(
+                self.obss.data[address:address+size], "little")
+            self._indexes.pop(info_name, None)
+            if info_name == "NAME":
+                self._used = None
+
+    def used_units(self):
+        # type: () -> list
+        # indexes of the units in use (see `used_name_values`)
+        if self._used is None:
+            names = used_name_values()
+            self._used = [i for i, value in enumerate(self.columns["NAME"]) if value in names]
+        return self._used
+
+    def index(self, info_name):
+        # value -> indexes of the units having that value (built on first use)
+        if info_name not in self._indexes:
+            index = collections.defaultdict(list)
+            for unit_index, value in enumerate(self.columns[info_name]):
+                index[value].append(unit_index)
+            self._indexes[info_name] = dict(index)
+        return self._indexes[info_name]
+
+
+class Army(object):
+    """
+    Groups of units of a slot, decoded in a single pass over `GROUPS_LAYOUT`.
+
+    "units formation" holds `GROUP_COUNT` groups of `GROUP_SIZE` unit indexes
+    (0xFF for an empty place); the first unit of a group is taken as its
+    leader. "units barraks" holds the units waiting outside of any group.
+    All the questions (members of a group, group of a unit, leader...) are
+    then dictionary lookups.
+    """
+
+    GROUP_COUNT = 25
+    GROUP_SIZE = 5
+    EMPTY = 0xFF
+
+    def __init__(self, obss):
+        self.obss = obss
+        # group -> unit indexes, only for non-empty groups
+        self.members = {}
+        # unit index -> group
+        self.group_of = {}
+        self.leaders = {}
+        self.barracks = []
+        formation = self._entry("units formation")[0]
+        barracks = self._entry("units barraks")[0]
+        data = obss.data
+        for group in range(Army.GROUP_COUNT):
+            start = formation + group*Army.GROUP_SIZE
+            units = [x for x in data[start:start+Army.GROUP_SIZE]
+                     if x < OgreBattleSaveState.UNIT_COUNT]
+            if not units:
+                continue
+            self.members[group] = units
+            self.leaders[group] = units[0]
+            for unit_index in units:
+                self.group_of[unit_index] = group
+        for unit_index in data[barracks:barracks+Army.GROUP_COUNT*Army.GROUP_SIZE]:
+            if (unit_index < OgreBattleSaveState.UNIT_COUNT and
+                    unit_index not in self.group_of and
+                    unit_index not in self.barracks):
+                self.barracks.append(unit_index)
+
+    @staticmethod
+    def _entry(info_name):
+        for entry in OgreBattleSaveState.GROUPS_LAYOUT:
+            if entry[3] == info_name:
+                return entry
+        raise RuntimeError(f"Found 0 of '{info_name}' inside 'GROUPS'!")
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        # (group, unit indexes) of the non-empty groups
+        return iter(sorted(self.members.items()))
+
+    def _check_group(self, group):
+        if not 0 <= group < Army.GROUP_COUNT:
+            raise IndexError(f"group {group} is capped at {Army.GROUP_COUNT}!")
+
+    def group(self, group):
+        # type: (int) -> list
+        self._check_group(group)
+        return list(self.members.get(group, ()))
+
+    def leader(self, group):
+        # type: (int) -> int
+        # unit index of the leader, None for an empty group
+        self._check_group(group)
+        return self.leaders.get(group)
+
+    def group_of_unit(self, unit_index):
+        # type: (int) -> int
+        # None when the unit is not deployed in any group
+        return self.group_of.get(unit_index)
+
+    def same_group(self, unit_index):
+        # type: (int) -> list
+        # the other units of the group of `unit_index`
+        group = self.group_of.get(unit_index)
+        if group is None:
+            return []
+        return [x for x in self.members[group] if x != unit_index]
+
+
+# filled by `_import_ast`: only queries pay for importing `ast`
+_QUERY_OPERATORS = None
+_QUERY_FLIPPED = None
+
+def _import_ast():
+    # binds the module global `ast` and builds the operator tables once
+    global ast, _QUERY_OPERATORS, _QUERY_FLIPPED
+    if _QUERY_OPERATORS is not None:
+        return
+    import ast
+    _QUERY_OPERATORS = {
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+    }
+    _QUERY_FLIPPED = {
+        ast.Eq: ast.Eq,
+        ast.NotEq: ast.NotEq,
+        ast.Lt: ast.Gt,
+        ast.LtE: ast.GtE,
+        ast.Gt: ast.Lt,
+        ast.GtE: ast.LtE,
+    }
+
+
+class UnitQuery(object):
+    """
+    Predicate over the units of a slot, compiled once from an expression like
+    `CLASS == 'Ninja' and LVL >= 10 and ITEM in ('none', 'Sonic Blad')`.
+
+    Names are the unit infos (spaces replaced by "_", e.g. GROUP_ROSTER).
+    Numbers are compared with the raw values, while CLASS, NAME and ITEM are
+    compared by name (only with ==, !=, in, not in) through the value index
+    of the roster. Conditions can be combined with and, or, not.
+    Evaluating the query returns the sorted indexes of the matching units,
+    among the units in use only (see `UnitTable.used_units`) unless
+    `all_units` is given.
+    """
+
+    CATALOG_FIELDS = ("CLASS", "NAME", "ITEM")
+
+    def __init__(self, expression):
+        _import_ast()
+        self.expression = expression
+        self.fields = {
+            x[3].replace(" ", "_"): x[3]
+            for x in OgreBattleSaveState.UNIT_LAYOUT if x[2] == 100
+        }
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise RuntimeError(f"Bad query '{expression}': {e}")
+        self._evaluate = self._compile(tree.body)
+
+    def __call__(self, obss, all_units=False):
+        # type: (OgreBattleSaveState, bool) -> list
+        roster = obss.get_roster()
+        units = range(len(roster)) if all_units else roster.used_units()
+        return sorted(self._evaluate(obss, roster, frozenset(units)))
+
+    def _error(self, node, message="unsupported syntax"):
+        return RuntimeError(f"Bad query '{self.expression}': {message} at column {node.col_offset}")
+
+    def _compile(self, node):
+        if isinstance(node, ast.BoolOp):
+            operands = [self._compile(x) for x in node.values]
+            if isinstance(node.op, ast.And):
+                def evaluate(obss, roster, units):
+                    for operand in operands:
+                        units = operand(obss, roster, units)
+                    return units
+            else:
+                def evaluate(obss, roster, units):
+                    res = set()
+                    for operand in operands:
+                        res |= operand(obss, roster, units)
+                    return frozenset(res)
+            return evaluate
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = self._compile(node.operand)
+            return lambda obss, roster, units: units - operand(obss, roster, units)
+        if isinstance(node, ast.Compare):
+            # chained comparisons (e.g. 10 <= LVL < 20) are a sequence of and
+            operands = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                operands.append(self._compile_comparison(node, left, op, right))
+                left = right
+            def evaluate(obss, roster, units):
+                for operand in operands:
+                    units = operand(obss, roster, units)
+                return units
+            return evaluate
+        raise self._error(node)
+
+    def _constant(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, str)):
+            return node.value
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            return tuple(self._constant(x) for x in node.elts)
+        raise self._error(node, "expected a number, a string or a list of them")
+
+    def _compile_comparison(self, node, left, op, right):
+        if isinstance(left, ast.Name):
+            field, constant = left, right
+        elif isinstance(right, ast.Name) and type(op) in _QUERY_FLIPPED:
+            field, constant = right, left
+            op = _QUERY_FLIPPED[type(op)]()
+        else:
+            raise self._error(node, "expected a comparison between an info and a value")
+        if field.id not in self.fields:
+            raise self._error(field, f"unknown info '{field.id}'")
+        info_name = self.fields[field.id]
+        constant = self._constant(constant)
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(constant, tuple):
+                raise self._error(node, "expected a list after 'in'")
+            wanted = constant
+        elif type(op) in _QUERY_OPERATORS and not isinstance(constant, tuple):
+            wanted = (constant, )
+        else:
+            raise self._error(node)
+        # names are compared by name, everything else by number: a mismatch
+        # would silently match nothing
+        expected = str if info_name in self.CATALOG_FIELDS else int
+        for value in wanted:
+            if not isinstance(value, expected) or isinstance(value, bool):
+                kind = "a name" if expected is str else "a number"
+                raise self._error(node, f"'{field.id}' must be compared with {kind}, not {value!r}")
+        negate = isinstance(op, (ast.NotIn, ast.NotEq))
+        if isinstance(op, (ast.Eq, ast.NotEq, ast.In, ast.NotIn)):
+            # equality goes through the value index of the roster
+            def evaluate(obss, roster, units):
+                index = roster.index(info_name)
+                found = set()
+                for value in self._values(obss, info_name, wanted):
+                    found.update(index.get(value, ()))
+                return units - found if negate else units & found
+            return evaluate
+        if info_name in self.CATALOG_FIELDS or not isinstance(constant, int):
+            raise self._error(node, f"'{field.id}' cannot be ordered")
+        compare = _QUERY_OPERATORS[type(op)]
+        def evaluate(obss, roster, units):
+            column = roster[info_name]
+            return frozenset(i for i in units if compare(column[i], constant))
+        return evaluate
+
+    def _values(self, obss, info_name, wanted):
+        # raw values matching the `wanted` constants
+        if info_name not in self.CATALOG_FIELDS:
+            return list(wanted)
+        catalog = {
+            "CLASS": get_catalog("classes"),
+            "NAME": obss.names,
+            "ITEM": get_catalog("items"),
+        }[info_name]
+        values = []
+        for name in wanted:
+            if info_name == "ITEM" and name == "none":
+                values.append(0)
+            else:
+                values.extend(catalog.values_of(name))
+        return values
+
+
+class Field(object):
+    """
+    Accessor of a single field of a layout, compiled once from its layout
+    entry: offset, size, number of items and codecs are precomputed so that
+    reading or writing does not look anything up.
+
+    It is also a descriptor of `UnitView`/`MiscView`: `state.units[3].STR`
+    and `state.misc.MONEY` return numbers for numeric fields and names
+    otherwise, and accept on assignment what the serializer accepts.
+    """
+
+    __slots__ = ("target", "name", "attr", "offset", "size", "count",
+                 "deserialize", "serialize", "numeric", "unpack", "is_leader_name")
+    UNPACKERS = {1: struct.Struct("<B").unpack_from, 2: struct.Struct("<H").unpack_from}
+
+    def __init__(self, target, entry):
+        offset, size, count, info_name, deserialize, serialize = entry
+        self.target = target
+        self.name = info_name
+        # attribute name: "GROUP ROSTER" -> GROUP_ROSTER, "x9?" -> x9
+        self.attr = info_name.replace(" ", "_").replace("?", "")
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.deserialize = deserialize
+        self.serialize = serialize
+        self.numeric = deserialize is bytes_to_num
+        self.unpack = self.UNPACKERS.get(size)
+        self.is_leader_name = (target, info_name) == ("MISC", "LEADER_NAME")
+
+    def _address(self, stride):
+        if stride >= self.count:
+            raise IndexError(f"stride {stride} for '{self.name}' is capped at {self.count}!")
+        return self.offset + stride*self.size
+
+    def value(self, obss, stride=0):
+        # type: (OgreBattleSaveState, int) -> int
+        address = self._address(stride)
+        if self.unpack is not None:
+            return self.unpack(obss.data, address)[0]
+        return int.from_bytes(obss.data[address:address+self.size], "little")
+
+    def read(self, obss, stride=0):
+        # type: (OgreBattleSaveState, int) -> ReadData
+        return ReadData.lazy(
+            name=self.name,
+            value=self.value(obss, stride),
+            address=obss.base_address + self._address(stride),
+            size=self.size,
+            deserialize=obss.bind_codec(self.deserialize),
+        )
+
+    def write(self, obss, stride, new_value):
+        self._write_bytes(obss, stride, new_value, obss.bind_codec(self.serialize)(new_value))
+
+    def write_value(self, obss, stride, value):
+        # type: (OgreBattleSaveState, int, int) -> None
+        # raw write, bypassing the serializer: e.g. the value of a catalog
+        # entry whose name is shared by several entries
+        self._write_bytes(obss, stride, value, int_to_bytes(value))
+
+    def _write_bytes(self, obss, stride, new_value, bytes_):
+        address = self._address(stride)
+        bytes_ = bytearray(bytes_)
+        if len(bytes_) > self.size:
+            raise RuntimeError(f"Bad size for '{self.name}': '{new_value}'->'{bytes_}'")
+        # during serialization we do not know the expected number of bytes to
+        # fill, but here we do. Hopefully padding with zeroes is always ok!
+        bytes_.extend(bytes(self.size - len(bytes_)))
+        obss._write(address, bytes_)
+        if self.is_leader_name:
+            obss._update_leader_name()
+
+    def __get__(self, view, owner=None):
+        if view is None:
+            return self
+        if self.numeric:
+            return self.value(view._obss, view._stride)
+        return self.read(view._obss, view._stride).formatted
+
+    def __set__(self, view, new_value):
+        self.write(view._obss, view._stride, new_value)
+
+
+class _LayoutView(object):
+
+    __slots__ = ("_obss", "_stride")
+
+    def __init__(self, obss, stride):
+        self._obss = obss
+        self._stride = stride
+
+
+class UnitView(_LayoutView):
+    """
+    A unit of a slot: every field of `UNIT_LAYOUT` is an attribute.
+    """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"<UnitView {self._stride} of slot {self._obss.index}>"
+
+
+class MiscView(_LayoutView):
+    """
+    Misc data of a slot: every field of `MISC_LAYOUT` is an attribute.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, obss):
+        super(MiscView, self).__init__(obss, 0)
+
+    def __repr__(self):
+        return f"<MiscView of slot {self._obss.index}>"
+
+
+class UnitList(object):
+    """
+    Sequence of the `UnitView` of a slot.
+    """
+
+    __slots__ = ("_obss", )
+
+    def __init__(self, obss):
+        self._obss = obss
+
+    def __len__(self):
+        return OgreBattleSaveState.UNIT_COUNT
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(f"unit {index} does not exist!")
+        return UnitView(self._obss, index)
+
+    def __iter__(self):
+        return (UnitView(self._obss, i) for i in range(len(self)))
 
 
 class OgreBattleSaveState(object):
@@ -109,7 +971,15 @@ class OgreBattleSaveState(object):
 
     START_ADDRESS = 0x0001
     SLOT_SIZE = 0xAAA
+    UNIT_COUNT = 100
     OPINION_LEADER_NAME_REF = 0x07a4
+    CHECKSUM_START_ADDRESS = 0x0003  # included
+    CHECKSUM_END_ADDRESS = 0x0aa8  # excluded
+    # cross-check the incremental checksum against a full recompute
+    DEBUG_CHECKSUM = bool(os.environ.get("OGREBATTLE_DEBUG_CHECKSUM"))
+    # default policy of `save`: see `write_patches`
+    SAVE_MODE = "journal"
+    SAVE_FSYNC = True
 
     # offset, size, number of items, field name, deserialize func, serialize func
     UNIT_LAYOUT = [
@@ -143,79 +1013,158 @@ class OgreBattleSaveState(object):
         (0x092f, 1, 1, "REPUTATION", bytes_to_num, num_to_bytes),
     ]
 
-    def __init__(self, file, index):
+    def __init__(self, file, index, data=None):
+        """
+        Read slot `index` of `file`. When `data` is given (a read-only view
+        of the slot, see `OgreBattleSaveFile`) the file is not read at all and
+        `data` is copied only on the first modification.
+        """
         if index not in (0, 1, 2):
             raise RuntimeError(f"Slot '{index}' does not exists in snes!")
         self.file = file
         self.index = index
-        self.data = []
-        with open(file, "rb") as f:
-            start = (OgreBattleSaveState.START_ADDRESS +
-                     OgreBattleSaveState.SLOT_SIZE*index)
-            size = OgreBattleSaveState.SLOT_SIZE
-            f.seek(start)
-            self.data = bytearray(f.read(size))
-            if len(self.data) != OgreBattleSaveState.SLOT_SIZE:
-                raise RuntimeError(
-                    f"problem reading slot {index} of file {file}: " +
-                    f"read {len(self.data)} bytes instead of {size}")
+        self._roster = None
+        self._army = None
+        # [start, end) ranges of `self.data` modified since the last save
+        self._dirty = []
+        self._in_transaction = False
+        size = OgreBattleSaveState.SLOT_SIZE
+        if data is None:
+            data = self._read_slot()
+        self.data = data
+        if len(self.data) != OgreBattleSaveState.SLOT_SIZE:
+            raise RuntimeError(
+                f"problem reading slot {index} of file {file}: " +
+                f"read {len(self.data)} bytes instead of {size}")
 
-        # update the name of the opinion leader
+        # the name of the opinion leader is stored inside the slot itself, so
+        # it is resolved by a per-instance overlay of the shared names
+        self.names = CatalogOverlay(get_catalog("names"))
+        self._codecs = {
+            bytes_to_name: lambda data: bytes_to_name(data, self.names),
+            name_to_bytes: lambda data: name_to_bytes(data, self.names),
+        }
+        self._update_leader_name()
+        # running checksum, kept up to date by every write
+        self._checksum = self.compute_checksum().value
+
+    def _update_leader_name(self):
         offset, size, _1, info_name, serialize, _2 = self.MISC_LAYOUT[1]
         assert(info_name == "LEADER_NAME")
         try:
-            leader_name = serialize(self.data[offset:offset+size])
+            leader_name = serialize(bytearray(self.data[offset:offset+size]))
         except Exception as e:
             # in case the slot is empty the bytes that should contain the
             # leader's name are filled with non-ascii bytes!
             leader_name = "unknown"
-        NAMES.append({
+        self.names.overlay = Catalog([{
             "value": self.OPINION_LEADER_NAME_REF,
             "name": leader_name,
-        })
+        }])
 
-    def _find_info_entry(self, target, info_name):
-        INFOS = {
-            "UNIT": OgreBattleSaveState.UNIT_LAYOUT,
-            "MISC": OgreBattleSaveState.MISC_LAYOUT,
-        }
-        if target not in INFOS:
+    def bind_codec(self, codec):
+        # codecs that depend on the content of the slot (e.g. the leader name)
+        return self._codecs.get(codec, codec)
+
+    @property
+    def base_address(self):
+        # absolute address of the slot inside the file
+        return OgreBattleSaveState.START_ADDRESS + self.index*OgreBattleSaveState.SLOT_SIZE
+
+    @property
+    def units(self):
+        # type: () -> UnitList
+        return UnitList(self)
+
+    @property
+    def misc(self):
+        # type: () -> MiscView
+        return MiscView(self)
+
+    def _find_field(self, target, info_name):
+        # type: (str, str) -> Field
+        fields = OgreBattleSaveState.FIELDS.get(target)
+        if fields is None:
             raise RuntimeError(f"Layout for '{target}' not found!")
-        entry = [x for x in INFOS[target] if x[3] == info_name]
-        if len(entry) != 1:
-            raise RuntimeError(f"Found {len(entry)} of '{info_name}' inside '{target}'!")
-        return entry[0]
+        field = fields.get(info_name)
+        if field is None:
+            raise RuntimeError(f"Found 0 of '{info_name}' inside '{target}'!")
+        return field
 
     def get_info(self, info_target, info_name, stride=0):
-        offset, size, max_stride, _1, deserialize, _2 = self._find_info_entry(info_target, info_name)
-        if stride >= max_stride:
-            raise IndexError(f"stride {stride} for '{info_name}' is capped at {max_stride}!")
-        address = offset + stride*size
-        abslute_address = (OgreBattleSaveState.START_ADDRESS +
-                           self.index*OgreBattleSaveState.SLOT_SIZE) + address
-        bytes_ = self.data[address:address+size]
-        res = ReadData(
-            name=info_name,
-            value=bytes_to_int(bytes_),
-            formatted=deserialize(bytes_),
-            raw=bytes_,
-            address=abslute_address,
-        )
-        return res
+        return self._find_field(info_target, info_name).read(self, stride)
+
+    def get_value(self, info_target, info_name, stride=0):
+        # type: (str, str, int) -> int
+        # fast path of `get_info(...).value`: no formatting, no copy
+        return self._find_field(info_target, info_name).value(self, stride)
 
     def set_info(self, new_value, info_target, info_name, stride=0):
-        offset, size, max_stride, _1, _2, serialize = self._find_info_entry(info_target, info_name)
-        if stride >= max_stride:
-            raise IndexError(f"stride {stride} for '{info_name}' is capped at {max_stride}!")
-        address = offset + stride*size
-        bytes_ = serialize(new_value)
-        if len(bytes_) > size:
-            raise RuntimeError(f"Bad size for '{info_name}': '{new_value}'->'{bytes_}'")
-        # during serialization we do not know the expected number of bytes to
-        # fill, but here we do. Hopefully padding with zeroes is always ok!
-        while len(bytes_) < size:
-            bytes_.append(0)
-        self.data[address:address+size] = bytes_
+        self._find_field(info_target, info_name).write(self, stride, new_value)
+
+    def set_value(self, value, info_target, info_name, stride=0):
+        # type: (int, str, str, int) -> None
+        # like `set_info`, but with the raw number (see `ReadData.value`)
+        self._find_field(info_target, info_name).write_value(self, stride, value)
+
+    def _write(self, address, bytes_):
+        # every modification of `self.data` must go through here, otherwise
+        # the running checksum gets out of sync
+        start = max(address, self.CHECKSUM_START_ADDRESS)
+        end = min(address + len(bytes_), self.CHECKSUM_END_ADDRESS)
+        if start < end:
+            delta = (sum(bytes_[start-address:end-address]) -
+                     sum(self.data[start:end]))
+            self._checksum = (self._checksum + delta) & 0xFFFF
+        if not isinstance(self.data, bytearray):
+            # copy-on-write of a view shared with an `OgreBattleSaveFile`
+            self.data = bytearray(self.data)
+        self.data[address:address+len(bytes_)] = bytes_
+        self._dirty.append((address, address+len(bytes_)))
+        self._roster = None
+        self._army = None
+
+    def _read_slot(self):
+        recover_journal(self.file)
+        with lock_file(self.file, exclusive=False), open(self.file, "rb") as f:
+            f.seek(OgreBattleSaveState.START_ADDRESS +
+                   OgreBattleSaveState.SLOT_SIZE*self.index)
+            return bytearray(f.read(OgreBattleSaveState.SLOT_SIZE))
+
+    def refresh(self):
+        """
+        Re-read the slot from the file (e.g. rewritten by the emulator) and
+        return its changes (see `diff_states`). Only the changed bytes are
+        processed: checksum and roster are updated in place, not rebuilt.
+        Unsaved modifications are lost.
+        """
+        data = self._read_slot()
+        if len(data) != OgreBattleSaveState.SLOT_SIZE:
+            raise RuntimeError(
+                f"problem reading slot {self.index} of file {self.file}: " +
+                f"read {len(data)} bytes instead of {OgreBattleSaveState.SLOT_SIZE}")
+        offsets = diff_offsets(self.data, data)
+        changes = group_changes(offsets)
+        for change in changes:
+            change["old"] = format_change(self, change)
+        checksum_delta = sum(
+            data[i] - self.data[i] for i in offsets
+            if self.CHECKSUM_START_ADDRESS <= i < self.CHECKSUM_END_ADDRESS)
+        self._checksum = (self._checksum + checksum_delta) & 0xFFFF
+        self.data = data
+        self._dirty = []
+        if any(x["field"] == "LEADER_NAME" for x in changes):
+            self._update_leader_name()
+        if self._roster is not None:
+            self._roster.update(changes)
+        if any(x["layout"] == "GROUPS" for x in changes):
+            self._army = None
+        for change in changes:
+            change["new"] = format_change(self, change)
+        return changes
+
+    def is_empty(self):
+        return is_empty_slot(self.data)
 
     def get_unit_info(self, unit_index, info_name):
         return self.get_info("UNIT", info_name, stride=unit_index)
@@ -223,6 +1172,32 @@ class OgreBattleSaveState(object):
     def set_unit_info(self, unit_index, info_name, new_value):
         self.set_info(new_value, "UNIT", info_name, stride=unit_index)
 
+    def set_unit_value(self, unit_index, info_name, value):
+        self.set_value(value, "UNIT", info_name, stride=unit_index)
+
+    def get_roster(self):
+        # the table is a snapshot: it is dropped by every `set_info`
+        if self._roster is None:
+            self._roster = UnitTable(self)
+        return self._roster
+
+    def get_army(self):
+        # type: () -> Army
+        # like the roster, rebuilt after every `set_info`
+        if self._army is None:
+            self._army = Army(self)
+        return self._army
+
+    def find_units(self, query, all_units=False):
+        """
+        Return the indexes of the units matching `query`, either an
+        expression (see `UnitQuery`) or an already compiled `UnitQuery`.
+        Unused places of the roster are skipped unless `all_units` is given.
+        """
+        if not isinstance(query, UnitQuery):
+            query = UnitQuery(query)
+        return query(self, all_units)
+
     def get_misc_info(self, info_name):
         return self.get_info("MISC", info_name)
 
@@ -232,16 +1207,24 @@ class OgreBattleSaveState(object):
     def get_checksum(self):
         return self.get_info("MISC", "CHECKSUM")
 
+    def running_checksum(self):
+        # O(1) alternative to `compute_checksum`
+        value = self._checksum
+        if self.DEBUG_CHECKSUM:
+            expected = self.compute_checksum().value
+            if value != expected:
+                raise RuntimeError(
+                    f"running checksum {value} differs from computed checksum {expected}!")
+        return value
+
     def update_checksum(self):
-        new_checksum = self.compute_checksum().value
+        new_checksum = self.running_checksum()
         self.set_info(new_checksum, "MISC", "CHECKSUM")
 
     def compute_checksum(self):
-        CHECKSUM_START_ADDRESS = 0x0003  # included
-        CHECKSUM_END_ADDRESS = 0x0aa8  # excluded
-        value = 0
-        for i in range(CHECKSUM_START_ADDRESS, CHECKSUM_END_ADDRESS):
-            value = (value + self.data[i]) & 0xFFFF
+        start = self.CHECKSUM_START_ADDRESS
+        end = self.CHECKSUM_END_ADDRESS
+        value = sum(self.data[start:end]) & 0xFFFF
         res = ReadData(
             name="COMPUTED_CHECKSUM",
             value=value,
@@ -251,12 +1234,746 @@ class OgreBattleSaveState(object):
         )
         return res
 
-    def save(self):
-        self.update_checksum()
-        with open(self.file, "rb") as f:
-            content = bytearray(f.read())
-        start = OgreBattleSaveState.START_ADDRESS + self.index*OgreBattleSaveState.SLOT_SIZE
-        end = start + OgreBattleSaveState.SLOT_SIZE
-        content[start:end] = self.data
-        with open(self.file, "wb") as f:
-            f.write(bytes(content))
+    def dirty_ranges(self):
+        # sorted and merged [start, end) ranges modified since the last save
+        merged = []
+        for start, end in sorted(self._dirty):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def pending_patches(self):
+        # (absolute address, bytes) to write inside the file on save
+        slot_address = OgreBattleSaveState.START_ADDRESS + self.index*OgreBattleSaveState.SLOT_SIZE
+        return [(slot_address + start, bytes(self.data[start:end]))
+                for start, end in self.dirty_ranges()]
+
+    def save(self, mode=None, fsync=None):
+        """
+        Persist the modifications, see `write_patches` for `mode` and `fsync`
+        (by default `SAVE_MODE` and `SAVE_FSYNC`).
+        Inside a `transaction` this does nothing: the transaction saves once
+        when it is committed.
+        """
+        if self._in_transaction:
+            return
+        save_states([self], mode=mode, fsync=fsync)
+
+    @contextlib.contextmanager
+    def transaction(self, mode=None, fsync=None):
+        """
+        Group many `set_info` (and `save`) in a single save, performed when the
+        `with` block exits normally. If the block raises, every modification
+        done inside it is rolled back and nothing is written.
+        Nested transactions are merged into the outermost one.
+        """
+        if self._in_transaction:
+            yield self
+            return
+        # a memoryview is never modified in place (copy-on-write)
+        data = self.data if isinstance(self.data, memoryview) else bytearray(self.data)
+        snapshot = (data, list(self._dirty), self._checksum, self.names.overlay)
+        self._in_transaction = True
+        try:
+            yield self
+        except BaseException:
+            self.data, self._dirty, self._checksum, self.names.overlay = snapshot
+            self._roster = None
+            self._army = None
+            raise
+        finally:
+            self._in_transaction = False
+        self.save(mode=mode, fsync=fsync)
+
+
+def _compile_fields(target, layout, view_class):
+    fields = {}
+    for entry in layout:
+        field = Field(target, entry)
+        fields[field.name] = field
+        setattr(view_class, field.attr, field)
+    return fields
+
+OgreBattleSaveState.FIELDS = {
+    "UNIT": _compile_fields("UNIT", OgreBattleSaveState.UNIT_LAYOUT, UnitView),
+    "MISC": _compile_fields("MISC", OgreBattleSaveState.MISC_LAYOUT, MiscView),
+}
+
+
+class OgreBattleSaveFile(object):
+    """
+    Whole save file, read once, exposing its 3 slots.
+
+    Slots are `OgreBattleSaveState` backed by read-only memoryview windows on
+    the content of the file: nothing is copied until a slot is modified. Slot
+    objects are created on demand and cached, so unsaved modifications of a
+    slot survive the selection of another slot.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        recover_journal(file)
+        with lock_file(file, exclusive=False), open(file, "rb") as f:
+            self.content = f.read()
+        self._slots = {}
+
+    def slot(self, index):
+        # type: (int) -> OgreBattleSaveState
+        if index not in self._slots:
+            if index not in (0, 1, 2):
+                raise RuntimeError(f"Slot '{index}' does not exists in snes!")
+            start = (OgreBattleSaveState.START_ADDRESS +
+                     OgreBattleSaveState.SLOT_SIZE*index)
+            window = memoryview(self.content)[start:start+OgreBattleSaveState.SLOT_SIZE]
+            self._slots[index] = OgreBattleSaveState(self.file, index, data=window)
+        return self._slots[index]
+
+    def slots(self):
+        return [self.slot(index) for index in range(3)]
+
+    def __getitem__(self, index):
+        return self.slot(index)
+
+    def modified_slots(self):
+        # type: () -> list
+        return [x for x in self._slots.values() if x.dirty_ranges()]
+
+    def save(self, mode=None, fsync=None):
+        # all the modified slots are committed together
+        save_states(self.modified_slots(), mode=mode, fsync=fsync)
+
+
+def is_empty_slot(data):
+    # an unused slot is completely filled with 0xFF
+    return bytes(data).count(0xFF) == len(data)
+
+
+def check_file_checksums(file, repair=False):
+    """
+    Verify the checksum of the 3 slots of `file` without decoding anything.
+
+    Return one dict per slot with the stored and the computed checksum and a
+    status among "ok", "mismatch", "repaired" and "empty" (an unused slot is
+    filled with 0xFF and is never repaired). With `repair` only the two bytes
+    of every wrong checksum are rewritten in place.
+    """
+    cls = OgreBattleSaveState
+    # a repair must not overwrite a save done meanwhile
+    with lock_file(file, exclusive=repair):
+        with open(file, "rb") as f:
+            content = f.read()
+        results = []
+        fixes = []
+        with memoryview(content) as view:
+            for index in range(3):
+                start = cls.START_ADDRESS + cls.SLOT_SIZE*index
+                slot = view[start:start+cls.SLOT_SIZE]
+                if len(slot) != cls.SLOT_SIZE:
+                    raise RuntimeError(
+                        f"problem reading slot {index} of file {file}: " +
+                        f"read {len(slot)} bytes instead of {cls.SLOT_SIZE}")
+                stored = bytes_to_int(bytes(slot[cls.CHECKSUM_END_ADDRESS:cls.CHECKSUM_END_ADDRESS+2]))
+                computed = sum(slot[cls.CHECKSUM_START_ADDRESS:cls.CHECKSUM_END_ADDRESS]) & 0xFFFF
+                if stored == computed:
+                    status = "ok"
+                elif is_empty_slot(slot):
+                    status = "empty"
+                elif repair:
+                    status = "repaired"
+                    fixes.append((start + cls.CHECKSUM_END_ADDRESS, computed))
+                else:
+                    status = "mismatch"
+                slot.release()
+                results.append({
+                    "slot": index,
+                    "status": status,
+                    "stored": stored,
+                    "computed": computed,
+                })
+        if fixes:
+            with open(file, "r+b") as f:
+                for address, checksum in fixes:
+                    f.seek(address)
+                    f.write(checksum.to_bytes(2, "little"))
+    return results
+
+
+def find_save_files(paths, pattern="*.srm"):
+    """
+    Yield every file matching `pattern` inside `paths` (recursively, sorted).
+    Paths that are files are yielded as they are. A file reached more than
+    once (e.g. `saves/ saves/a.srm`, or through a symlink) is yielded once:
+    workers must never write the same file at the same time.
+    """
+    seen = set()
+    def first_time(file):
+        real_path = os.path.realpath(file)
+        if real_path in seen:
+            return False
+        seen.add(real_path)
+        return True
+    for path in paths:
+        if not os.path.isdir(path):
+            if first_time(path):
+                yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(fnmatch.filter(files, pattern)):
+                file = os.path.join(root, file)
+                if first_time(file):
+                    yield file
+
+
+JOURNAL_MAGIC = b"OBJ1"
+JOURNAL_END = b"END!"
+
+def journal_file(file):
+    return f"{file}.journal"
+
+@contextlib.contextmanager
+def lock_file(file, exclusive=True):
+    """
+    Hold an advisory lock on `file`: exclusive while saving (see
+    `write_patches`) or replaying a journal, shared while reading. Nothing is
+    locked where `fcntl` is not available.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(file, "rb") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+def _remove_journal(file):
+    # the journal could have been replayed by a process without locks
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(journal_file(file))
+
+def _fsync_dir(path):
+    # make a rename/unlink durable (not supported everywhere, e.g. windows)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _apply_in_place(file, patches, fsync):
+    with open(file, "r+b") as f:
+        for address, bytes_ in patches:
+            f.seek(address)
+            f.write(bytes_)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+def write_journal(file, patches, fsync=True):
+    """
+    Write the journal of `file`: the patches followed by a crc32 and an end
+    marker, so that a truncated journal is recognized and discarded.
+    """
+    content = bytearray(JOURNAL_MAGIC)
+    for address, bytes_ in patches:
+        content += struct.pack("<IH", address, len(bytes_))
+        content += bytes_
+    content += struct.pack("<I", zlib.crc32(content))
+    content += JOURNAL_END
+    with open(journal_file(file), "wb") as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    if fsync:
+        _fsync_dir(file)
+
+def read_journal(file):
+    # type: (str) -> list
+    # return the patches of a complete journal, None if missing or truncated
+    try:
+        with open(journal_file(file), "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    if (len(content) < len(JOURNAL_MAGIC) + 4 + len(JOURNAL_END) or
+            not content.startswith(JOURNAL_MAGIC) or
+            not content.endswith(JOURNAL_END)):
+        return None
+    body = content[:-4-len(JOURNAL_END)]
+    crc, = struct.unpack("<I", content[-4-len(JOURNAL_END):-len(JOURNAL_END)])
+    if zlib.crc32(body) != crc:
+        return None
+    patches = []
+    i = len(JOURNAL_MAGIC)
+    while i < len(body):
+        address, size = struct.unpack_from("<IH", body, i)
+        i += 6
+        patches.append((address, body[i:i+size]))
+        i += size
+    return patches
+
+def recover_journal(file):
+    """
+    Replay the journal left by an interrupted save of `file`, holding the
+    lock of the file: a save in progress keeps it until its journal is gone.
+    A journal that was not completely written is left alone (the file was
+    not touched yet) and overwritten by the next save.
+    Return True if the journal was replayed.
+    """
+    if not os.path.exists(journal_file(file)):
+        return False
+    with lock_file(file):
+        patches = read_journal(file)
+        if patches is None:
+            return False
+        _apply_in_place(file, patches, fsync=True)
+        _remove_journal(file)
+    return True
+
+def _replace_atomically(file, patches, fsync):
+    with open(file, "rb") as f:
+        content = bytearray(f.read())
+    for address, bytes_ in patches:
+        content[address:address+len(bytes_)] = bytes_
+    import tempfile
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(file), suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(file)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp_file, os.stat(file).st_mode & 0o7777)
+        os.replace(tmp_file, file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    if fsync:
+        _fsync_dir(file)
+
+def write_patches(file, patches, mode="journal", fsync=True):
+    """
+    Write (absolute address, bytes) `patches` inside `file`. Modes:
+     * "journal": the patches are first stored inside `<file>.journal`, then
+       written in place; an interrupted save is completed (or discarded) by
+       `recover_journal` the next time the file is opened
+     * "atomic": the whole file is rewritten into a temporary file that then
+       replaces the original one
+     * "inplace": the patches are written in place, without any protection
+    `fsync` can be disabled to trade durability for speed in batch jobs.
+    The file is locked (see `lock_file`) for the whole save.
+    """
+    if mode not in ("journal", "atomic", "inplace"):
+        raise RuntimeError(f"Unknown save mode '{mode}'!")
+    with lock_file(file):
+        if mode == "journal":
+            write_journal(file, patches, fsync)
+            _apply_in_place(file, patches, fsync)
+            _remove_journal(file)
+        elif mode == "atomic":
+            _replace_atomically(file, patches, fsync)
+        else:
+            _apply_in_place(file, patches, fsync)
+
+def collect_patches(states):
+    # type: (list) -> list
+    """
+    Rewrite the checksum of the `states` (slots of the same file) and return
+    the patches of all of them for `write_patches`. Nothing is written: the
+    states stay modified until `mark_saved`. The states are not touched by
+    `write_patches`, which can then run on another thread.
+    """
+    patches = []
+    for state in states:
+        # the checksum is always rewritten: `fix-checksum` relies on it
+        state.update_checksum()
+        patches.extend(state.pending_patches())
+    return patches
+
+def mark_saved(states):
+    for state in states:
+        state._dirty = []
+
+def save_states(states, mode=None, fsync=None):
+    """
+    Save many `OgreBattleSaveState` at once (group commit): the modified slots
+    of the same file are written with a single journal/rename/fsync.
+    """
+    mode = mode or OgreBattleSaveState.SAVE_MODE
+    fsync = OgreBattleSaveState.SAVE_FSYNC if fsync is None else fsync
+    by_file = collections.defaultdict(list)
+    for state in states:
+        by_file[state.file].append(state)
+    for file, file_states in by_file.items():
+        write_patches(file, collect_patches(file_states), mode, fsync)
+        mark_saved(file_states)
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+_PATCH_CATALOGS = {"CLASS": "classes", "NAME": "names", "ITEM": "items"}
+
+def _patch_values(info_name, name):
+    # type: (str, str) -> list
+    # raw values standing for the CLASS/NAME/ITEM `name` of a patch
+    if info_name == "ITEM" and name == "none":
+        return [0]
+    return get_catalog(_PATCH_CATALOGS[info_name]).values_of(name)
+
+def _compile_patch_value(field, value):
+    # type: (Field, object) -> int
+    # raw value to write inside `field`, rejecting anything that the
+    # serializers would silently turn into 0 (e.g. a misspelled class)
+    if field.name in _PATCH_CATALOGS:
+        if isinstance(value, str):
+            values = _patch_values(field.name, value)
+            if not values:
+                raise RuntimeError(f"Unknown {field.name} '{value}' inside patch!")
+            if len(values) > 1:
+                raise RuntimeError(
+                    f"{field.name} '{value}' is shared by values " +
+                    f"{', '.join(map(str, values))}: use one of them inside patch!")
+            return values[0]
+        catalog = get_catalog(_PATCH_CATALOGS[field.name])
+        known = (catalog.find("value", value) is not None or
+                 (field.name == "ITEM" and value == 0) or
+                 (field.name == "NAME" and value == OgreBattleSaveState.OPINION_LEADER_NAME_REF))
+        if isinstance(value, bool) or not isinstance(value, int) or not known:
+            raise RuntimeError(f"Unknown {field.name} {value!r} inside patch!")
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise RuntimeError(f"'{field.name}' must be a number inside patch, not {value!r}!")
+    if not 0 <= value < 1 << (8*field.size):
+        raise RuntimeError(f"Value {value} of '{field.name}' does not fit in {field.size} bytes!")
+    return value
+
+def compile_patch(spec):
+    """
+    Validate a patch `spec` and return it in a normalized form:
+
+        {
+            "slots": [0, 1, 2],                   # optional, default all
+            "misc": {"MONEY": 999999},            # optional
+            "units": [                            # optional
+                {"select": {"CLASS": "Ninja", "unit": [0, 1]},
+                 "set": {"STR": 255}},
+            ]
+        }
+
+    Selectors are "unit" (indexes), "CLASS" and "NAME" (names): a value can
+    also be a list of alternatives, and all the selectors must match. An
+    empty "select" matches every unit.
+
+    Everything is checked here, before touching any file: unknown names,
+    names shared by several values (use the value instead) and numbers that
+    do not fit inside their field raise. Values are normalized to the raw
+    numbers to write (the leader name is kept as a string).
+    """
+    unit_fields = OgreBattleSaveState.FIELDS["UNIT"]
+    misc_fields = OgreBattleSaveState.FIELDS["MISC"]
+    unknown = set(spec) - {"slots", "misc", "units"}
+    if unknown:
+        raise RuntimeError(f"Unknown keys {sorted(unknown)} inside patch!")
+    slots = _as_list(spec.get("slots", [0, 1, 2]))
+    for index in slots:
+        if index not in (0, 1, 2):
+            raise RuntimeError(f"Slot '{index}' does not exists in snes!")
+    misc = {}
+    for info_name, value in spec.get("misc", {}).items():
+        if info_name not in misc_fields:
+            raise RuntimeError(f"Found 0 of '{info_name}' inside 'MISC'!")
+        field = misc_fields[info_name]
+        misc[info_name] = str(value) if field.is_leader_name else _compile_patch_value(field, value)
+    units = []
+    for rule in spec.get("units", []):
+        if "set" not in rule:
+            raise RuntimeError(f"Missing 'set' inside patch rule {rule}!")
+        select = {k: _as_list(v) for k, v in rule.get("select", {}).items()}
+        for key, wanted in select.items():
+            if key == "unit":
+                for unit_index in wanted:
+                    if unit_index not in range(OgreBattleSaveState.UNIT_COUNT):
+                        raise IndexError(f"unit {unit_index!r} is capped at {OgreBattleSaveState.UNIT_COUNT}!")
+            elif key in ("CLASS", "NAME"):
+                for name in wanted:
+                    if not _patch_values(key, name):
+                        raise RuntimeError(f"Unknown {key} '{name}' inside patch!")
+            else:
+                raise RuntimeError(f"Cannot select units by '{key}'!")
+        assignments = {}
+        for info_name, value in rule["set"].items():
+            if info_name not in unit_fields:
+                raise RuntimeError(f"Found 0 of '{info_name}' inside 'UNIT'!")
+            assignments[info_name] = _compile_patch_value(unit_fields[info_name], value)
+        units.append({"select": select, "set": assignments})
+    return {"slots": slots, "misc": misc, "units": units}
+
+def select_units(obss, select):
+    # type: (OgreBattleSaveState, dict) -> list
+    roster = obss.get_roster()
+    selected = range(len(roster))
+    if "unit" in select:
+        wanted = set(select["unit"])
+        selected = [i for i in selected if i in wanted]
+    for info_name, catalog in (("CLASS", get_catalog("classes")), ("NAME", obss.names)):
+        if info_name in select:
+            values = {v for name in select[info_name] for v in catalog.values_of(name)}
+            column = roster[info_name]
+            selected = [i for i in selected if column[i] in values]
+    return list(selected)
+
+def patch_file(file, spec, dry_run=False, mode=None, fsync=None):
+    """
+    Apply a compiled patch `spec` (see `compile_patch`) to all the non-empty
+    slots of `file`, writing the file once. Return a report per slot.
+    """
+    save_file = OgreBattleSaveFile(file)
+    report = []
+    for index in spec["slots"]:
+        obss = save_file.slot(index)
+        if obss.is_empty():
+            report.append({"slot": index, "status": "empty"})
+            continue
+        units = set()
+        for rule in spec["units"]:
+            for unit_index in select_units(obss, rule["select"]):
+                for info_name, value in rule["set"].items():
+                    obss.set_unit_value(unit_index, info_name, value)
+                units.add(unit_index)
+        for info_name, value in spec["misc"].items():
+            if isinstance(value, int):
+                obss.set_value(value, "MISC", info_name)
+            else:
+                obss.set_misc_info(info_name, value)
+        report.append({"slot": index, "status": "patched", "units": sorted(units)})
+    if not dry_run:
+        save_file.save(mode=mode, fsync=fsync)
+    return report
+
+def _record_value(data, deserialize):
+    # numbers are exported as numbers, everything else as formatted string
+    if deserialize is bytes_to_num:
+        return data.value
+    return data.formatted
+
+def iter_records(paths, records=("unit", "misc")):
+    """
+    Yield a flat dict for every unit in use ("unit" records, see
+    `UnitTable.used_units`) and/or every slot ("misc" records) of all the
+    non-empty slots of the save files inside `paths`, one file at a time.
+    Every record holds "record", "file", "slot", "unit" (unit records only)
+    and all the fields of its layout.
+    """
+    for file in find_save_files(paths):
+        save_file = OgreBattleSaveFile(file)
+        for obss in save_file.slots():
+            if obss.is_empty():
+                continue
+            if "unit" in records:
+                roster = obss.get_roster()
+                for unit_index in roster.used_units():
+                    record = {"record": "unit", "file": file, "slot": obss.index, "unit": unit_index}
+                    for _1, _2, count, info_name, deserialize, _3 in OgreBattleSaveState.UNIT_LAYOUT:
+                        if unit_index < count:
+                            data = roster.get(unit_index, info_name)
+                            record[info_name] = _record_value(data, deserialize)
+                    yield record
+            if "misc" in records:
+                record = {"record": "misc", "file": file, "slot": obss.index}
+                for _1, _2, _3, info_name, deserialize, _4 in OgreBattleSaveState.MISC_LAYOUT:
+                    try:
+                        data = obss.get_misc_info(info_name)
+                        record[info_name] = _record_value(data, deserialize)
+                    except UnicodeDecodeError:
+                        record[info_name] = None
+                yield record
+
+
+FieldSpan = collections.namedtuple("FieldSpan",
+    ("start", "end", "layout", "name", "size", "deserialize"))
+
+_FIELD_INDEX = None
+
+def field_index():
+    """
+    Sorted `FieldSpan` intervals [start, end) of every field of
+    `UNIT_LAYOUT`, `GROUPS_LAYOUT` and `MISC_LAYOUT` (offsets are relative to
+    the slot), built once.
+    """
+    global _FIELD_INDEX
+    if _FIELD_INDEX is None:
+        spans = []
+        layouts = (
+            ("UNIT", OgreBattleSaveState.UNIT_LAYOUT),
+            ("GROUPS", OgreBattleSaveState.GROUPS_LAYOUT),
+            ("MISC", OgreBattleSaveState.MISC_LAYOUT),
+        )
+        for layout_name, layout in layouts:
+            for entry in layout:
+                offset, size, count, info_name, deserialize = entry[:5]
+                if size*count == 0:
+                    continue
+                spans.append(FieldSpan(offset, offset + size*count, layout_name,
+                                       info_name, size, deserialize))
+        spans.sort()
+        _FIELD_INDEX = (spans, [x.start for x in spans])
+    return _FIELD_INDEX
+
+def field_at(offset):
+    """
+    Return `(FieldSpan, index)` of the field containing the slot `offset`,
+    or `(None, None)` if no known field contains it.
+    """
+    spans, starts = field_index()
+    i = bisect.bisect_right(starts, offset) - 1
+    if i >= 0 and offset < spans[i].end:
+        span = spans[i]
+        return span, (offset - span.start) // span.size
+    return None, None
+
+def diff_offsets(a, b, block_size=64):
+    # offsets where the buffers differ: whole blocks are compared in bulk and
+    # scanned byte by byte only when they differ
+    a = memoryview(a)
+    b = memoryview(b)
+    res = []
+    for start in range(0, len(a), block_size):
+        end = start + block_size
+        if a[start:end] != b[start:end]:
+            res.extend(i for i in range(start, min(end, len(a))) if a[i] != b[i])
+    return res
+
+def format_change(obss, change):
+    # value of a change (see `group_changes`) as decoded inside `obss`
+    address, size = change["offset"], change["size"]
+    bytes_ = bytearray(obss.data[address:address+size])
+    if change["layout"] is None:
+        return _as_hex(bytes_)
+    span, _ = field_at(address)
+    try:
+        return obss.bind_codec(span.deserialize)(bytes_)
+    except Exception:
+        return _as_hex(bytes_)
+
+def _as_hex(data):
+    return " ".join("{:02x}".format(x) for x in data)
+
+def group_changes(offsets):
+    """
+    Group sorted changed `offsets` into one dict per changed field (or per
+    run of changed bytes outside of any known field) with "layout", "field",
+    "index", "offset" and "size".
+    """
+    changes = []
+    for offset in offsets:
+        span, index = field_at(offset)
+        if span is None:
+            last = changes[-1] if changes else None
+            if last and last["layout"] is None and last["offset"] + last["size"] == offset:
+                last["size"] += 1
+            else:
+                changes.append({"layout": None, "field": None, "index": None, "offset": offset, "size": 1})
+            continue
+        address = span.start + index*span.size
+        if changes and changes[-1]["layout"] == span.layout and changes[-1]["offset"] == address:
+            # another byte of the same (multi-byte) field
+            continue
+        changes.append({
+            "layout": span.layout,
+            "field": span.name,
+            "index": index,
+            "offset": address,
+            "size": span.size,
+        })
+    return changes
+
+def diff_states(a, b):
+    """
+    Field-aware difference between two slots: return the changes of
+    `group_changes` completed with the "old" and the "new" decoded values.
+    """
+    changes = group_changes(diff_offsets(a.data, b.data))
+    for change in changes:
+        change["old"] = format_change(a, change)
+        change["new"] = format_change(b, change)
+    return changes
+
+
+# instrumentation: `enable_stats` replaces the functions listed inside
+# `_PROBES` by timed wrappers, `enable_stats(False)` puts the originals back,
+# so nothing is measured (and nothing is paid) while it is disabled
+
+_STATS = collections.defaultdict(lambda: [0, 0.0])
+_ORIGINALS = {}
+
+def _timed(key, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            entry = _STATS[key]
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+    return wrapper
+
+def _codec_key(codec):
+    # bytes_to_class -> "decode.class", num_to_bytes -> "encode.num"
+    name = getattr(codec, "__name__", "codec")
+    if name.startswith("bytes_to_"):
+        return "decode." + name[len("bytes_to_"):]
+    if name.endswith("_to_bytes"):
+        return "encode." + name[:-len("_to_bytes")]
+    return "codec." + name
+
+def _timed_bind_codec(bind_codec):
+    def wrapper(self, codec):
+        return _timed(_codec_key(codec), bind_codec(self, codec))
+    return wrapper
+
+_PROBES = (
+    (sys.modules[__name__], "load_table", "catalog"),
+    (OgreBattleSaveState, "_read_slot", "load"),
+    (OgreBattleSaveFile, "__init__", "load"),
+    (UnitTable, "__init__", "decode.roster"),
+    (OgreBattleSaveState, "bind_codec", _timed_bind_codec),
+    (OgreBattleSaveState, "compute_checksum", "checksum"),
+    (sys.modules[__name__], "check_file_checksums", "checksum"),
+    (sys.modules[__name__], "write_patches", "save"),
+)
+
+def enable_stats(enabled=True):
+    """
+    Start (or stop) collecting the number of calls and the cumulative time of
+    loads, catalog loads, decodes/encodes by codec, checksums and saves: see
+    `stats`. Collected data is kept until `reset_stats`.
+    """
+    if enabled and not _ORIGINALS:
+        for owner, attr, key in _PROBES:
+            func = vars(owner)[attr]
+            _ORIGINALS[(owner, attr)] = func
+            wrapper = key(func) if callable(key) else _timed(key, func)
+            setattr(owner, attr, functools.wraps(func)(wrapper))
+    elif not enabled:
+        for (owner, attr), func in _ORIGINALS.items():
+            setattr(owner, attr, func)
+        _ORIGINALS.clear()
+
+def reset_stats():
+    _STATS.clear()
+
+def stats():
+    # type: () -> dict
+    # {operation: {"calls": ..., "seconds": ...}}, sorted by time
+    return {key: {"calls": calls, "seconds": seconds}
+            for key, (calls, seconds) in sorted(_STATS.items(), key=lambda x: -x[1][1])}
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
+import json
+import os
 import unittest
 import tempfile
+import warnings
 
+import benchmark
+import corpus
+import filewatch
 import savestate
+import worker
 
 
 class TestSavestate(unittest.TestCase):
@@ -52,8 +59,7 @@ class TestSavestate(unittest.TestCase):
         for address, _1, _2, _3, _4, raw, _5 in values:
             data[address:address+len(raw)] = raw[:]
 
-        #with tempfile.NamedTemporaryFile(mode="w+b") as f:
-        with open("dump", "w+b") as f:
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
             f.write(bytes(data))
             f.flush()
 
@@ -65,5 +71,640 @@ class TestSavestate(unittest.TestCase):
                 self.assertEqual(obtained_value.value, expected_value)
                 self.assertEqual(obtained_value.formatted, expected_formatted)
 
+    def test_roster(self):
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        roster = obss.get_roster()
+        self.assertEqual(len(roster), 100)
+        for offset, size, count, info_name, _1, _2 in obss.UNIT_LAYOUT:
+            self.assertEqual(len(roster[info_name]), count)
+            for unit_index in range(count):
+                expected = obss.get_unit_info(unit_index, info_name)
+                obtained = roster.get(unit_index, info_name)
+                self.assertEqual(obtained, expected)
+        with self.assertRaises(IndexError):
+            roster.get(100, "STR")
+        # writes drop the cached snapshot
+        obss.set_unit_info(3, "STR", "42")
+        self.assertEqual(obss.get_roster().value(3, "STR"), 42)
+
+    def test_catalog(self):
+        catalog = savestate.Catalog([
+            {"value": 1, "name": "A"},
+            {"value": 2, "name": "B"},
+            {"value": 3, "name": "A"},
+        ])
+        self.assertEqual(catalog.find("value", 3)["name"], "A")
+        self.assertEqual(catalog.find("name", "B")["value"], 2)
+        self.assertIsNone(catalog.find("value", 4))
+        catalog.append({"value": 4, "name": "C"})
+        self.assertEqual(catalog.find("name", "C")["value"], 4)
+        self.assertEqual(len(catalog), 4)
+        # duplicated names keep the first match, but complain about it
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.assertEqual(catalog.find_name("A")["value"], 1)
+            self.assertEqual(catalog.find_name("B")["value"], 2)
+        self.assertEqual(len(caught), 1)
+        # the warning points at the caller, not inside savestate
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            savestate.name_to_bytes("WILLIAM")
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(caught[0].filename, __file__)
+        self.assertEqual(savestate.bytes_to_name(bytes([0x3c, 0x8d])), "ARNOLD")
+        self.assertEqual(savestate.name_to_bytes("ARNOLD"), [0x3c, 0x8d])
+        # an empty catalog is a catalog, not a missing one
+        self.assertEqual(savestate.bytes_to_name(bytes([0x3c, 0x8d]), savestate.Catalog()), "unknown")
+        self.assertEqual(savestate.name_to_bytes("ARNOLD", savestate.Catalog()), [0x00])
+
+    def test_table_cache(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            cache_dir = os.path.join(data_dir, "cache")
+            json_file = os.path.join(data_dir, "classes.json")
+            with open(json_file, "w") as f:
+                json.dump([{"value": 1, "name": "Ninja", "img": "R0lG"}], f)
+            entries = savestate.load_table("classes", data_dir=data_dir, cache_dir=cache_dir)
+            self.assertEqual(entries, [{"value": 1, "name": "Ninja"}])
+            sprites = savestate.load_table("classes", "sprites", data_dir=data_dir, cache_dir=cache_dir)
+            self.assertEqual(sprites, {1: "R0lG"})
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, "classes.entries.pickle")))
+            # a modified json invalidates the cache
+            with open(json_file, "w") as f:
+                json.dump([{"value": 2, "name": "Wizard", "img": "R0lG"}], f)
+            os.utime(json_file, ns=(0, 0))
+            entries = savestate.load_table("classes", data_dir=data_dir, cache_dir=cache_dir)
+            self.assertEqual(entries, [{"value": 2, "name": "Wizard"}])
+            # a touched but unchanged json still hits the cache
+            os.utime(json_file, ns=(10**9, 10**9))
+            with open(os.path.join(cache_dir, "classes.entries.pickle"), "rb") as f:
+                self.assertIn(b"Wizard", f.read())
+            entries = savestate.load_table("classes", data_dir=data_dir, cache_dir=cache_dir)
+            self.assertEqual(entries, [{"value": 2, "name": "Wizard"}])
+            # ...and refreshes the stamp: the json is not hashed anymore
+            file_digest = savestate._file_digest
+            savestate._file_digest = None
+            try:
+                entries = savestate.load_table("classes", data_dir=data_dir, cache_dir=cache_dir)
+            finally:
+                savestate._file_digest = file_digest
+            self.assertEqual(entries, [{"value": 2, "name": "Wizard"}])
+
+    def test_leader_name(self):
+        names_count = len(savestate.NAMES)
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
+            data = bytearray(1 + 0x0aaa*3)
+            for slot_index, leader_name in enumerate([b"LANCE", b"DESTIN", b""]):
+                start = 1 + slot_index*0x0aaa
+                # leader name and NAME of unit 0 (the opinion leader)
+                data[start+0x0910:start+0x0910+len(leader_name)] = leader_name
+                data[start+0x0645:start+0x0647] = [0xa4, 0x07]
+            f.write(bytes(data))
+            f.flush()
+            slots = [savestate.OgreBattleSaveState(f.name, i) for i in range(3)]
+            self.assertEqual(slots[0].get_unit_info(0, "NAME").formatted, "LANCE")
+            self.assertEqual(slots[1].get_unit_info(0, "NAME").formatted, "DESTIN")
+            self.assertEqual(slots[1].get_roster().get(0, "NAME").formatted, "DESTIN")
+            self.assertEqual(slots[2].get_unit_info(0, "NAME").formatted, "")
+            slots[0].set_misc_info("LEADER_NAME", "ASH")
+            self.assertEqual(slots[0].get_unit_info(0, "NAME").formatted, "ASH")
+            slots[0].set_unit_info(1, "NAME", "ASH")
+            self.assertEqual(slots[0].get_unit_info(1, "NAME").value, 0x07a4)
+            # the leader is listed only by the names of its own slot
+            leader = slots[1].names.find_name("DESTIN")
+            self.assertEqual(leader["value"], 0x07a4)
+            slots[1].set_unit_value(2, "NAME", leader["value"])
+            self.assertEqual(slots[1].get_unit_info(2, "NAME").formatted, "DESTIN")
+            self.assertIsNone(savestate.NAMES.find_name("DESTIN"))
+            # duplicated names are written by value, without any guess
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                slots[1].set_unit_value(2, "NAME", 36319)
+            self.assertEqual(caught, [])
+            self.assertEqual(slots[1].get_unit_info(2, "NAME").value, 36319)
+            self.assertEqual(slots[1].get_unit_info(2, "NAME").formatted, "WILLIAM")
+            self.assertEqual(slots[1].running_checksum(), slots[1].compute_checksum().value)
+        # the shared catalog is never modified
+        self.assertEqual(len(savestate.NAMES), names_count)
+        self.assertEqual(savestate.bytes_to_name(bytes([0xa4, 0x07])), "unknown")
+
+    def test_running_checksum(self):
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        obss.set_unit_info(3, "STR", "255")
+        obss.set_unit_info(4, "HP", "999")
+        obss.set_unit_info(5, "CLASS", "Ninja")
+        obss.set_misc_info("MONEY", "999999")
+        obss.set_misc_info("LEADER_NAME", "ASH")
+        # writing the checksum itself does not change the running checksum
+        obss.set_misc_info("CHECKSUM", "0")
+        self.assertEqual(obss.running_checksum(), obss.compute_checksum().value)
+        obss.update_checksum()
+        self.assertEqual(obss.get_checksum().value, obss.compute_checksum().value)
+
+    def test_check_file_checksums(self):
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = bytearray(f.read())
+        # break the checksum of slot 1
+        content[1 + 0x0aaa + 0x0aa8] ^= 0xFF
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
+            f.write(content)
+            f.flush()
+            statuses = [x["status"] for x in savestate.check_file_checksums(f.name)]
+            self.assertEqual(statuses, ["ok", "mismatch", "empty"])
+            statuses = [x["status"] for x in savestate.check_file_checksums(f.name, repair=True)]
+            self.assertEqual(statuses, ["ok", "repaired", "empty"])
+            statuses = [x["status"] for x in savestate.check_file_checksums(f.name)]
+            self.assertEqual(statuses, ["ok", "ok", "empty"])
+
+    def test_save_file(self):
+        save_file = savestate.OgreBattleSaveFile("data/OgreBattle_MotBQ.srm")
+        slot0, slot1, slot2 = save_file.slots()
+        self.assertIs(save_file[0], slot0)
+        # slots share the content of the file until they are modified
+        self.assertIsInstance(slot1.data, memoryview)
+        self.assertEqual(slot1.data.obj, save_file.content)
+        expected = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 1)
+        self.assertEqual(bytes(slot1.data), bytes(expected.data))
+        self.assertEqual(slot1.get_unit_info(0, "NAME"), expected.get_unit_info(0, "NAME"))
+        self.assertEqual(slot1.get_roster().get(7, "CLASS"), expected.get_roster().get(7, "CLASS"))
+        slot1.set_unit_info(7, "STR", "99")
+        self.assertIsInstance(slot1.data, bytearray)
+        self.assertEqual(slot1.get_unit_info(7, "STR").value, 99)
+        self.assertEqual(slot1.running_checksum(), slot1.compute_checksum().value)
+        # the shared content is untouched
+        start = 1 + 0x0aaa
+        self.assertEqual(save_file.content[start:start+0x0aaa], bytes(expected.data))
+
+    def test_save(self):
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
+            f.write(content)
+            f.flush()
+            obss = savestate.OgreBattleSaveState(f.name, 1)
+            obss.set_misc_info("MONEY", "123456")
+            obss.set_unit_info(3, "STR", "200")
+            obss.set_unit_info(3, "STR", "201")
+            self.assertEqual(len(obss.dirty_ranges()), 2)
+            obss.save()
+            self.assertEqual(obss.dirty_ranges(), [])
+            f.seek(0)
+            saved = f.read()
+            self.assertEqual(len(saved), len(content))
+            changed = [i for i in range(len(content)) if content[i] != saved[i]]
+            slot_address = 1 + 0x0aaa
+            allowed = [slot_address + 0x092b, slot_address + 0x092c, slot_address + 0x092d,
+                       slot_address + 0x02c1 + 3, slot_address + 0x0aa8, slot_address + 0x0aa9]
+            self.assertTrue(set(changed) <= set(allowed))
+            reloaded = savestate.OgreBattleSaveState(f.name, 1)
+            self.assertEqual(reloaded.get_misc_info("MONEY").value, 123456)
+            self.assertEqual(reloaded.get_unit_info(3, "STR").value, 201)
+            self.assertEqual(reloaded.get_checksum().value, reloaded.compute_checksum().value)
+
+    def test_save_modes(self):
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file = os.path.join(tmp_dir, "save.srm")
+            for mode in ("journal", "atomic", "inplace"):
+                with open(file, "wb") as f:
+                    f.write(content)
+                save_file = savestate.OgreBattleSaveFile(file)
+                save_file[0].set_unit_info(1, "LVL", "20")
+                save_file[1].set_misc_info("REPUTATION", "100")
+                save_file.save(mode=mode, fsync=False)
+                self.assertEqual(os.listdir(tmp_dir), ["save.srm"])
+                results = savestate.check_file_checksums(file)
+                self.assertEqual([x["status"] for x in results], ["ok", "ok", "empty"])
+                reloaded = savestate.OgreBattleSaveFile(file)
+                self.assertEqual(reloaded[0].get_unit_info(1, "LVL").value, 20)
+                self.assertEqual(reloaded[1].get_misc_info("REPUTATION").value, 100)
+
+    def test_journal_recovery(self):
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file = os.path.join(tmp_dir, "save.srm")
+            with open(file, "wb") as f:
+                f.write(content)
+            # a complete journal is replayed when the file is opened
+            savestate.write_journal(file, [(1 + 0x092f, b"\x2a")], fsync=False)
+            obss = savestate.OgreBattleSaveState(file, 0)
+            self.assertEqual(obss.get_misc_info("REPUTATION").value, 42)
+            self.assertFalse(os.path.exists(savestate.journal_file(file)))
+            # a truncated journal is ignored (never deleted by a reader) and
+            # overwritten by the next save
+            savestate.write_journal(file, [(1 + 0x092f, b"\x07")], fsync=False)
+            with open(savestate.journal_file(file), "r+b") as f:
+                f.truncate(8)
+            obss = savestate.OgreBattleSaveState(file, 0)
+            self.assertEqual(obss.get_misc_info("REPUTATION").value, 42)
+            self.assertTrue(os.path.exists(savestate.journal_file(file)))
+            obss.set_misc_info("REPUTATION", "43")
+            obss.save(mode="journal", fsync=False)
+            self.assertFalse(os.path.exists(savestate.journal_file(file)))
+            # a reader waits for the save in progress instead of replaying
+            # (and removing) its journal
+            if savestate.fcntl is not None:
+                import threading
+                read = []
+                with savestate.lock_file(file):
+                    savestate.write_journal(file, [(1 + 0x092f, b"\x2c")], fsync=False)
+                    reader = threading.Thread(target=lambda: read.append(
+                        savestate.OgreBattleSaveState(file, 0).get_misc_info("REPUTATION").value))
+                    reader.start()
+                    reader.join(0.2)
+                    self.assertEqual(read, [])
+                    savestate._apply_in_place(file, [(1 + 0x092f, b"\x2c")], fsync=False)
+                    savestate._remove_journal(file)
+                reader.join()
+                self.assertEqual(read, [44])
+            # the journal already replayed by somebody else is not an error
+            apply_in_place = savestate._apply_in_place
+            def replayed_meanwhile(file, patches, fsync):
+                apply_in_place(file, patches, fsync)
+                os.remove(savestate.journal_file(file))
+            savestate._apply_in_place = replayed_meanwhile
+            try:
+                obss.set_misc_info("REPUTATION", "45")
+                obss.save(mode="journal", fsync=False)
+            finally:
+                savestate._apply_in_place = apply_in_place
+            self.assertEqual(obss.dirty_ranges(), [])
+            self.assertEqual(savestate.OgreBattleSaveState(file, 0).get_misc_info("REPUTATION").value, 45)
+
+    def test_transaction(self):
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
+            f.write(content)
+            f.flush()
+            obss = savestate.OgreBattleSaveState(f.name, 0)
+            with obss.transaction():
+                for unit_index in range(21):
+                    obss.set_unit_info(unit_index, "STR", "255")
+                    obss.save()
+                # nothing written until the transaction is committed
+                self.assertNotEqual(savestate.OgreBattleSaveState(f.name, 0).get_unit_info(20, "STR").value, 255)
+            reloaded = savestate.OgreBattleSaveState(f.name, 0)
+            self.assertEqual(reloaded.get_unit_info(20, "STR").value, 255)
+            self.assertEqual(reloaded.get_checksum().value, reloaded.compute_checksum().value)
+            # a failing transaction is rolled back
+            with self.assertRaises(IndexError):
+                with obss.transaction():
+                    obss.set_misc_info("MONEY", "1")
+                    obss.set_unit_info(100, "STR", "1")
+            self.assertNotEqual(obss.get_misc_info("MONEY").value, 1)
+            self.assertEqual(obss.running_checksum(), obss.compute_checksum().value)
+            self.assertEqual(obss.dirty_ranges(), [])
+
+    def test_patch(self):
+        with self.assertRaises(RuntimeError):
+            savestate.compile_patch({"units": [{"select": {"LVL": 1}, "set": {"STR": 1}}]})
+        # values are checked before any file is touched
+        for bad in [
+            {"units": [{"set": {"CLASS": "Ninjaa"}}]},
+            {"units": [{"set": {"NAME": "WILLIAM"}}]},
+            {"units": [{"set": {"ITEM": 12345}}]},
+            {"units": [{"set": {"STR": 256}}]},
+            {"units": [{"set": {"HP": "lots"}}]},
+            {"units": [{"select": {"CLASS": "Wizzard"}, "set": {"LVL": 1}}]},
+            {"units": [{"select": {"CLASS": "Wizard"}}]},
+            {"misc": {"REPUTATION": -1}},
+        ]:
+            with self.assertRaises(RuntimeError, msg=bad):
+                savestate.compile_patch(bad)
+        with self.assertRaises(IndexError):
+            savestate.compile_patch({"units": [{"select": {"unit": 100}, "set": {"LVL": 1}}]})
+        spec = savestate.compile_patch({"units": [{"set": {"NAME": 36319, "ITEM": "none", "HP": "300"}}]})
+        self.assertEqual(spec["units"][0]["set"], {"NAME": 36319, "ITEM": 0, "HP": 300})
+        spec = savestate.compile_patch({
+            "slots": [0, 2],
+            "misc": {"REPUTATION": 100},
+            "units": [{"select": {"CLASS": "Wizard", "unit": [0, 1, 2]}, "set": {"LVL": 50}}],
+        })
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
+            f.write(content)
+            f.flush()
+            report = savestate.patch_file(f.name, spec, fsync=False)
+            self.assertEqual(report, [
+                {"slot": 0, "status": "patched", "units": [1]},
+                {"slot": 2, "status": "empty"},
+            ])
+            slot0, slot1, slot2 = savestate.OgreBattleSaveFile(f.name).slots()
+            self.assertEqual(slot0.get_unit_info(1, "LVL").value, 50)
+            self.assertEqual(slot0.get_misc_info("REPUTATION").value, 100)
+            self.assertEqual(bytes(slot1.data), content[1+0x0aaa:1+2*0x0aaa])
+            self.assertTrue(slot2.is_empty())
+
+    def test_find_save_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            a = os.path.join(tmp_dir, "a.srm")
+            b = os.path.join(tmp_dir, "sub", "b.srm")
+            os.makedirs(os.path.dirname(b))
+            for file in (a, b):
+                open(file, "wb").close()
+            os.symlink(b, os.path.join(tmp_dir, "c.srm"))
+            # every file once, even when reached by many paths
+            files = list(savestate.find_save_files([tmp_dir, a, b]))
+            self.assertEqual(files, [a, os.path.join(tmp_dir, "c.srm")])
+
+    def test_iter_records(self):
+        records = list(savestate.iter_records(["data/OgreBattle_MotBQ.srm"]))
+        units = [x for x in records if x["record"] == "unit"]
+        misc = [x for x in records if x["record"] == "misc"]
+        # the 3rd slot is empty, unused units are skipped
+        self.assertEqual([(x["slot"], x["unit"]) for x in units],
+                         [(0, i) for i in range(5)] + [(1, i) for i in range(48)])
+        self.assertEqual([x["slot"] for x in misc], [0, 1])
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 1)
+        self.assertEqual(units[6]["STR"], obss.get_unit_info(1, "STR").value)
+        self.assertEqual(units[6]["CLASS"], obss.get_unit_info(1, "CLASS").formatted)
+        self.assertEqual(misc[1]["MONEY"], obss.get_misc_info("MONEY").value)
+
+    @unittest.skipIf(corpus.np is None, "NumPy is not installed")
+    def test_corpus(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            copy = os.path.join(tmp_dir, "copy.srm")
+            with open("data/OgreBattle_MotBQ.srm", "rb") as f, open(copy, "wb") as g:
+                g.write(f.read())
+            loaded = corpus.load_corpus(["data/OgreBattle_MotBQ.srm", copy])
+        self.assertEqual(loaded.units.shape, (2, 3, 100))
+        self.assertEqual(loaded.empty.tolist(), [[False, False, True]]*2)
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 1)
+        roster = obss.get_roster()
+        for info_name in loaded.units.dtype.names:
+            self.assertEqual(loaded.units[1, 1][info_name].tolist(), roster[info_name].tolist())
+        self.assertEqual(int(loaded.misc[0, 1]["MONEY"]), obss.get_misc_info("MONEY").value)
+        # the unused places of the roster (0x55 filler) are left out
+        self.assertEqual(loaded.used[1, 1].nonzero()[0].tolist(), roster.used_units())
+        wizards = []
+        for slot_index in (0, 1):
+            slot_roster = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", slot_index).get_roster()
+            wizards += [slot_roster["STR"][i] for i in slot_roster.used_units()
+                        if slot_roster.get(i, "CLASS").formatted == "Wizard"]
+        means = loaded.mean_by_class("STR")
+        self.assertAlmostEqual(means["Wizard"], sum(wizards)/len(wizards))
+        self.assertNotIn("Buildings", means)
+        counts, _ = loaded.histogram("LVL")
+        self.assertEqual(counts.sum(), 2*(5 + 48))
+
+    def test_find_units(self):
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        query = savestate.UnitQuery("CLASS in ('Wizard', 'Fighter') and 2 <= LVL < 4")
+        expected = [
+            i for i in range(100)
+            if obss.get_unit_info(i, "CLASS").formatted in ("Wizard", "Fighter")
+            and 2 <= obss.get_unit_info(i, "LVL").value < 4
+        ]
+        self.assertEqual(obss.find_units(query, all_units=True), expected)
+        # units 5-99 are unused places of the roster, filled with 0x55
+        self.assertEqual(obss.find_units(query), [x for x in expected if x < 5])
+        self.assertEqual(obss.find_units("LVL >= 10"), [])
+        self.assertEqual(len(obss.find_units("LVL >= 10", all_units=True)), 95)
+        self.assertEqual(obss.find_units("NAME == 'BAKLA'"), [0])
+        self.assertEqual(obss.find_units("not LVL > 1 or NAME == 'TOMO'"), [0, 1])
+        obss.set_unit_info(3, "STR", "250")
+        self.assertEqual(obss.find_units("STR == 250"), [3])
+        bad_queries = (
+            "CLASS > 1", "FOO == 1", "LVL + 1", "LVL in 3",
+            # mismatched types would silently match nothing
+            "CLASS == 19", "NAME in ('TOMO', 3)", "ITEM != 0", "LVL == '10'",
+            "STR in (1, 'x')", "LVL == True",
+        )
+        for bad in bad_queries:
+            with self.assertRaises(RuntimeError):
+                savestate.UnitQuery(bad)
+
+    def test_diff(self):
+        span, index = savestate.field_at(0x01f9 + 2*7 + 1)
+        self.assertEqual((span.layout, span.name, index), ("UNIT", "HP", 7))
+        self.assertEqual(savestate.field_at(0x0809)[0].name, "units barraks")
+        self.assertEqual(savestate.field_at(0x0003), (None, None))
+        a = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        b = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        self.assertEqual(savestate.diff_states(a, b), [])
+        b.set_unit_info(7, "HP", "999")
+        b.set_misc_info("MONEY", "1")
+        b._write(0x0005, b"\xaa\xbb")
+        changes = [(x["layout"], x["field"], x["index"], x["new"]) for x in savestate.diff_states(a, b)]
+        self.assertEqual(changes, [
+            (None, None, None, "aa bb"),
+            ("UNIT", "HP", 7, "999"),
+            ("MISC", "MONEY", 0, "1"),
+        ])
+
+    def test_refresh(self):
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file = os.path.join(tmp_dir, "save.srm")
+            with open(file, "wb") as f:
+                f.write(content)
+            obss = savestate.OgreBattleSaveState(file, 0)
+            roster = obss.get_roster()
+            self.assertEqual(roster.index("LVL")[2], [1, 2, 3, 4])
+            watcher = filewatch.PollingWatcher(file, interval=0.01)
+            self.assertFalse(watcher.wait(timeout=0))
+            other = savestate.OgreBattleSaveState(file, 0)
+            other.set_unit_info(1, "LVL", "9")
+            other.set_misc_info("LEADER_NAME", "ASH")
+            other.save(fsync=False)
+            os.utime(file, ns=(1, 1))
+            self.assertTrue(watcher.wait(timeout=1))
+            changes = obss.refresh()
+            self.assertEqual(
+                [(x["field"], x["index"], x["old"], x["new"]) for x in changes if x["field"] != "CHECKSUM"],
+                [("LVL", 1, "2", "9"), ("LEADER_NAME", 0, "BAKLA", "ASH")])
+            # the roster is updated in place
+            self.assertIs(obss.get_roster(), roster)
+            self.assertEqual(roster.index("LVL")[2], [2, 3, 4])
+            self.assertEqual(obss.get_unit_info(0, "NAME").formatted, "ASH")
+            self.assertEqual(obss.running_checksum(), obss.compute_checksum().value)
+            self.assertEqual(obss.refresh(), [])
+
+    def test_field_accessors(self):
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        unit = obss.units[1]
+        self.assertEqual(unit.STR, obss.get_unit_info(1, "STR").value)
+        self.assertEqual(unit.CLASS, "Wizard")
+        self.assertEqual(unit.NAME, "TOMO")
+        self.assertEqual(unit.GROUP_ROSTER, obss.get_unit_info(1, "GROUP ROSTER").value)
+        self.assertEqual(obss.misc.MONEY, 30000)
+        unit.STR = unit.STR + 1
+        unit.CLASS = "Ninja"
+        obss.misc.MONEY = 123
+        obss.misc.LEADER_NAME = "ASH"
+        self.assertEqual(obss.get_unit_info(1, "STR").value, unit.STR)
+        self.assertEqual(obss.get_unit_info(1, "CLASS").formatted, "Ninja")
+        self.assertEqual(obss.get_misc_info("MONEY").value, 123)
+        self.assertEqual(obss.units[0].NAME, "ASH")
+        self.assertEqual(obss.running_checksum(), obss.compute_checksum().value)
+        self.assertEqual(len(obss.units), 100)
+        with self.assertRaises(IndexError):
+            obss.units[100]
+        with self.assertRaises(AttributeError):
+            obss.misc.STR
+        with self.assertRaises(RuntimeError):
+            obss.get_info("GROUPS", "units formation")
+
+    def test_lazy_read(self):
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        data = obss.get_unit_info(1, "NAME")
+        self.assertEqual(obss.get_value("UNIT", "NAME", 1), data.value)
+        self.assertEqual(data.raw, bytearray(data.value.to_bytes(2, "little")))
+        self.assertEqual(data.formatted, "TOMO")
+        name, value, formatted, raw, address = data
+        self.assertEqual((name, formatted, address), ("NAME", "TOMO", 0x0648))
+        self.assertEqual(data, savestate.ReadData("NAME", value, "TOMO", raw, 0x0648))
+        # still indexable and hashable like the namedtuple it used to be
+        self.assertEqual((data[0], data[2], data[-1], len(data)), ("NAME", "TOMO", 0x0648, 5))
+        self.assertEqual(data[:2], ("NAME", value))
+        self.assertIn(savestate.ReadData("NAME", value, "TOMO", bytes(raw), 0x0648), {data})
+        self.assertEqual(len({obss.get_checksum(), obss.get_checksum()}), 1)
+        self.assertEqual(obss.get_value("MISC", "MONEY"), 30000)
+        with self.assertRaises(IndexError):
+            obss.get_value("UNIT", "STR", 100)
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = benchmark.generate_corpus(tmp_dir, 2, seed=1)
+            self.assertEqual(len(files), 2)
+            for file in files:
+                self.assertTrue(all(x["status"] in ("ok", "empty") for x in savestate.check_file_checksums(file)))
+            results = benchmark.run(files, 1, cli=False)
+        self.assertIn("compute_checksum", results)
+        baseline = {"save": {"per_op": results["save"]["per_op"]/2}}
+        self.assertEqual(list(benchmark.compare(results, baseline, 0.5)), ["save"])
+        self.assertEqual(benchmark.compare(results, baseline, 1.5), {})
+
+    def test_stats(self):
+        read_slot = savestate.OgreBattleSaveState._read_slot
+        savestate.reset_stats()
+        savestate.enable_stats()
+        try:
+            obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+            obss.get_unit_info(1, "CLASS").formatted
+            obss.get_unit_info(1, "NAME")
+            obss.set_unit_info(1, "STR", 50)
+            stats = savestate.stats()
+        finally:
+            savestate.enable_stats(False)
+        self.assertEqual(stats["load"]["calls"], 1)
+        self.assertEqual(stats["checksum"]["calls"], 1)
+        self.assertEqual(stats["decode.class"]["calls"], 1)
+        self.assertEqual(stats["encode.num"]["calls"], 1)
+        # NAME was never formatted: nothing decoded
+        self.assertNotIn("decode.name", stats)
+        self.assertIs(savestate.OgreBattleSaveState._read_slot, read_slot)
+        savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        self.assertEqual(savestate.stats()["load"]["calls"], 1)
+        savestate.reset_stats()
+        self.assertEqual(savestate.stats(), {})
+
+    def test_army(self):
+        obss = savestate.OgreBattleSaveState("data/OgreBattle_MotBQ.srm", 0)
+        army = obss.get_army()
+        self.assertEqual(list(army), [(0, [0, 1, 2, 3, 4])])
+        self.assertEqual(army.leader(0), 0)
+        self.assertIsNone(army.leader(1))
+        self.assertEqual(army.group_of_unit(3), 0)
+        self.assertIsNone(army.group_of_unit(50))
+        self.assertEqual(army.same_group(1), [0, 2, 3, 4])
+        with self.assertRaises(IndexError):
+            army.group(25)
+        # move unit 4 into group 1, as its leader
+        obss._write(0x078a + 4, b"\xff")
+        obss._write(0x078a + 5, b"\x04")
+        army = obss.get_army()
+        self.assertEqual(army.group(0), [0, 1, 2, 3])
+        self.assertEqual(army.leader(1), 4)
+        self.assertEqual(army.same_group(4), [])
+
+    def test_worker(self):
+        import threading
+        import time
+        background = worker.Worker()
+        gate = threading.Event()
+        results = []
+        def task(job, value):
+            gate.wait()
+            job.report(f"running {value}")
+            return value
+        def fail(job):
+            raise RuntimeError("boom")
+        progress = []
+        background.submit(task, 1, key="load", callback=results.append, progress=progress.append)
+        background.submit(task, 2, key="load", callback=results.append)
+        background.submit(task, 3, key="load", callback=results.append)
+        errors = []
+        background.submit(fail, errback=errors.append)
+        gate.set()
+        deadline = time.monotonic() + 5
+        while background.poll() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        background.close()
+        # only the newest "load" is delivered, whatever the others did
+        self.assertEqual(results, [3])
+        self.assertEqual(progress, [])
+        self.assertEqual([str(x) for x in errors], ["boom"])
+        self.assertEqual(background.poll(), 0)
+
+    def test_gui_jobs(self):
+        import guiviewer
+        with open("data/OgreBattle_MotBQ.srm", "rb") as f:
+            content = f.read()
+        with tempfile.NamedTemporaryFile(mode="w+b") as f:
+            f.write(content)
+            f.flush()
+            background = worker.Worker()
+            loaded = []
+            background.submit(guiviewer.load_slot, f.name, 0, callback=loaded.append)
+            background.close()
+            background.poll()
+            save_file, slot0 = loaded[0]
+            # switching slot keeps the edits of the previous one
+            slot0.set_unit_info(0, "STR", "77")
+            save_file.slot(1).set_unit_info(7, "STR", "99")
+            # the slots are prepared by the GUI thread, the worker only writes
+            states = save_file.modified_slots()
+            self.assertEqual(len(states), 2)
+            patches = savestate.collect_patches(states)
+            data = [x.data for x in states]
+            rosters = [x.get_roster() for x in states]
+            background = worker.Worker()
+            background.submit(guiviewer.write_file, f.name, patches)
+            background.close()
+            background.poll()
+            for state, state_data, roster in zip(states, data, rosters):
+                self.assertIs(state.data, state_data)
+                self.assertIs(state.get_roster(), roster)
+            savestate.mark_saved(states)
+            self.assertEqual(save_file.modified_slots(), [])
+            self.assertEqual(savestate.OgreBattleSaveState(f.name, 0).get_unit_info(0, "STR").value, 77)
+            self.assertEqual(savestate.OgreBattleSaveState(f.name, 1).get_unit_info(7, "STR").value, 99)
+
+    def test_catalog_search(self):
+        catalog = savestate.Catalog([
+            {"value": 1, "name": "ARNOLD"},
+            {"value": 2, "name": "BARNEY"},
+            {"value": 3, "name": "MARNA"},
+            {"value": 4, "name": "ARKYS"},
+        ])
+        names = lambda entries: [x["name"] for x in entries]
+        self.assertEqual(names(catalog.search("arn")), ["ARNOLD", "BARNEY", "MARNA"])
+        self.assertEqual(names(catalog.search("ar")), ["ARNOLD", "ARKYS", "BARNEY", "MARNA"])
+        self.assertEqual(names(catalog.search("Arnol")), ["ARNOLD"])
+        self.assertEqual(names(catalog.search("arnx")), [])
+        self.assertEqual(len(catalog.search("")), 4)
+        # the index follows `append`
+        catalog.append({"value": 5, "name": "NARNIA"})
+        self.assertEqual(names(catalog.search("arn")), ["ARNOLD", "BARNEY", "MARNA", "NARNIA"])
+        overlay = savestate.CatalogOverlay(catalog, [{"value": 6, "name": "ARNE"}])
+        self.assertEqual(names(overlay.search("arn"))[:2], ["ARNOLD", "ARNE"])
+        names_ = savestate.get_catalog("names")
+        self.assertEqual(names_.search("arnold"), [x for x in names_ if "arnold" in x["name"].lower()])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,101 @@
+"""
+Run slow operations (file I/O, checksums...) on a background thread and hand
+their results back to the thread polling them (e.g. the Tk main loop).
+"""
+import queue
+import threading
+
+
+class Job(object):
+    """
+    A function submitted to a `Worker`. It is called as `func(job, *args)`,
+    so that it can `report` its progress and stop early once `cancelled`.
+    """
+
+    def __init__(self, worker, key, generation, func, args, callback, errback, progress):
+        self.worker = worker
+        self.key = key
+        self.generation = generation
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.progress = progress
+
+    @property
+    def cancelled(self):
+        # a newer job with the same key has been submitted
+        return (self.key is not None and
+                self.worker._generations.get(self.key) != self.generation)
+
+    def report(self, message):
+        self.worker._results.put((self, "progress", message))
+
+
+class Worker(object):
+    """
+    Single background thread executing jobs in submission order.
+
+    Results, errors and progress reports are queued and delivered by `poll`,
+    which must be called by the thread owning the GUI (Tk is not thread safe):
+    callbacks always run there. Submitting a job with the same `key` of older
+    ones cancels them: they are skipped if not started yet and their results
+    are dropped otherwise.
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._generations = {}
+        # jobs submitted but not delivered by `poll` yet
+        self._pending = 0
+        self._thread = threading.Thread(target=self._run, name="worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, key=None, callback=None, errback=None, progress=None):
+        # type: (...) -> Job
+        generation = self._generations.get(key, 0) + 1
+        if key is not None:
+            self._generations[key] = generation
+        job = Job(self, key, generation, func, args, callback, errback, progress)
+        self._pending += 1
+        self._jobs.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if job.cancelled:
+                self._results.put((job, "skipped", None))
+                continue
+            try:
+                result = job.func(job, *job.args)
+            except Exception as e:
+                self._results.put((job, "error", e))
+            else:
+                self._results.put((job, "done", result))
+
+    def poll(self):
+        # type: () -> int
+        # deliver the queued results, return the number of jobs still pending
+        while True:
+            try:
+                job, kind, value = self._results.get_nowait()
+            except queue.Empty:
+                return self._pending
+            if kind != "progress":
+                self._pending -= 1
+            if job.cancelled or kind == "skipped":
+                continue
+            handler = {"done": job.callback, "error": job.errback, "progress": job.progress}[kind]
+            if handler is not None:
+                handler(value)
+            elif kind == "error":
+                print("ERROR '{}': {}".format(getattr(job.func, "__name__", "job"), value))
+
+    def close(self):
+        # wait for the jobs already submitted, then stop the thread
+        self._jobs.put(None)
+        self._thread.join()